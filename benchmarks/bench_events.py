@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Benchmark of date parsing, sorting and event grouping for large libraries, reported in seconds per phase.
+
+    python3 benchmarks/bench_events.py
+    python3 benchmarks/bench_events.py --records 100000 --gap 2
+
+Synthetic exiftool date strings are grouped three ways:
+  per-record : datetime.strptime and one event lookup per file
+  bulk       : parse_exif_dates() and event_plan() without numpy
+  numpy      : the same with numpy, if it is installed
+All three must produce the same plan. No exiftool or media files are needed;
+event directories are created in a temporary directory.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import photorg.photorg as photorg
+from photorg.photorg import PathDates, parse_exif_dates, event_plan, new_event_dir, EXIF_DATE_FORMAT
+
+
+def make_records(count, seed=0):
+    """return (paths, date strings) in listing order, clustered into trips with quiet weeks between"""
+    rng = random.Random(seed)
+    paths = []
+    date_strs = []
+    date = datetime(2005, 1, 1)
+    while len(paths) < count:
+        date += timedelta(days=rng.randint(1, 30))
+        for i in range(min(rng.randint(1, 2000), count - len(paths))):
+            taken = date + timedelta(seconds=rng.randint(0, 5 * 86400))
+            paths.append('/photos/{0:07d}/IMG_{1:04d}.JPG'.format(len(paths) // 1000, len(paths) % 10000))
+            date_strs.append(taken.strftime(EXIF_DATE_FORMAT))
+    # exiftool reports files in listing order, not date order
+    order = list(range(count))
+    rng.shuffle(order)
+    return [paths[i] for i in order], [date_strs[i] for i in order]
+
+
+def per_record(paths, date_strs, dest, gap):
+    """one strptime, sort key and event comparison per file"""
+    timings = []
+    start = time.perf_counter()
+    dates = PathDates(paths)
+    for i,date_str in enumerate(date_strs):
+        dates[i] = datetime.strptime(date_str, EXIF_DATE_FORMAT)
+    timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    dated = (i for i in range(len(paths)) if dates.has_date(i))
+    order = sorted(dated, key=dates.stamps.__getitem__)
+    timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    plan = []
+    event_date = None
+    for i in order:
+        path, date = paths[i], dates.get(i)
+        if event_date is None or (date - event_date).days > gap:
+            event_date = date
+            event_dir = new_event_dir(dest, event_date)
+        plan.append((path, date, os.path.join(event_dir, os.path.basename(path))))
+    timings.append(time.perf_counter() - start)
+    return plan, timings
+
+
+def bulk(paths, date_strs, dest, gap):
+    timings = []
+    start = time.perf_counter()
+    dates = PathDates(paths)
+    dates.stamps = parse_exif_dates(date_strs)
+    timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    dates.sort()
+    timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    plan = event_plan(dates, dest, gap)
+    timings.append(time.perf_counter() - start)
+    return plan, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=1000000, help='number of files (default 1000000)')
+    parser.add_argument('--gap', type=int, default=4, help='days between events, as photorg --gap (default 4)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths, date_strs = make_records(args.records, args.seed)
+    numpy = photorg.numpy
+    methods = [('per-record', per_record, None), ('bulk', bulk, None)]
+    if numpy is not None:
+        methods.append(('numpy', bulk, numpy))
+    else:
+        print("numpy is not installed; skipping the numpy method", file=sys.stderr)
+
+    print("{0:>10} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8}".format('method', 'parse', 'sort', 'group', 'total', 'speedup'))
+    reference = None
+    baseline = None
+    for name,func,module in methods:
+        photorg.numpy = module
+        dest = tempfile.mkdtemp(prefix='bench_events_')
+        try:
+            plan, timings = func(paths, date_strs, dest, args.gap)
+        finally:
+            shutil.rmtree(dest)
+            photorg.numpy = numpy
+        total = sum(timings)
+        baseline = baseline or total
+        print("{0:>10} {1:>8.2f} {2:>8.2f} {3:>8.2f} {4:>8.2f} {5:>7.1f}x".format(name, timings[0], timings[1], timings[2], total, baseline / total))
+        sys.stdout.flush()
+        # compare targets relative to each temporary dest
+        plan = [(path, date, os.path.relpath(target, dest)) for path,date,target in plan]
+        if reference is None:
+            reference = plan
+        elif plan != reference:
+            sys.exit("{0} plan differs from per-record plan".format(name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of photorg on a synthetic tree (see corpus.py), phase by phase.
+
+    python3 benchmarks/bench_suite.py --files 2000 --output results.json
+    python3 benchmarks/bench_suite.py --corpus /tmp/corpus --jobs 4 --output new.json --compare old.json
+
+Each phase runs in a fresh python process so peak RSS is its own, and reports wall and CPU time,
+files/s, MB/s, peak RSS of photorg and of its exiftool/ffprobe children, and read/write syscall
+counts and bytes read from /proc/self/io (Linux; photorg's process only, not its children).
+  sha1      : sha1 of every file, one after the other
+  sha1sums  : deduplicate's hashing of the tree with --jobs threads
+  duplicates: find_duplicates (sampled prefilter, then full hashes)
+  dates     : exiftool and ffprobe date extraction with --jobs workers
+  organize  : dates, event grouping and copying into an empty destination
+Without exiftool or ffprobe installed (or with --tools stub), the stand-ins in benchmarks/stubs are used;
+they read only the tags the corpus writes, so they measure photorg's overhead rather than the tools'.
+Results record the corpus options and tree version; --compare prints the time ratio of each phase to an earlier result.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import corpus
+
+PHASES = ['sha1', 'sha1sums', 'duplicates', 'dates', 'organize']
+STUBS = os.path.join(HERE, 'stubs')
+
+
+def tool(name, path, choice):
+    """path of the real tool or its stub"""
+    if choice == 'real' or (choice == 'auto' and os.path.exists(path)):
+        return path
+    return os.path.join(STUBS, name)
+
+
+def proc_io():
+    """read/write syscall counts and storage bytes of this process"""
+    try:
+        with open('/proc/self/io') as f:
+            return dict((k, int(v)) for k,v in (line.split(':') for line in f))
+    except (OSError, ValueError):
+        return {}
+
+
+def drop_cache(directory):
+    """drop the files under directory from the page cache"""
+    from photorg.common import ls, fadvise
+    for path in ls(directory, relative=False, isfile=True):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fadvise(fd, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def run_phase(name, directory, jobs, exiftool, ffprobe):
+    """run one phase in this process and return its measurements and result counts"""
+    import photorg.photorg
+    from photorg.common import ls, sha1
+    from photorg.exiftool import ExiftoolPool
+    from photorg.deduplicate import sha1sums, find_duplicates
+
+    photorg.photorg.FFPROBE = ffprobe
+    # undated files are expected; keep their warnings out of the report
+    logging.getLogger('photorg').addHandler(logging.NullHandler())
+    paths = list(ls(directory, relative=False, isfile=True))
+    size = sum(os.path.getsize(p) for p in paths)
+    result = {}
+    dest = None
+
+    io = proc_io()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+
+    if name == 'sha1':
+        result['digests'] = len(set(sha1(p) for p in paths))
+    elif name == 'sha1sums':
+        result['digests'] = len(sha1sums([directory], jobs=jobs))
+    elif name == 'duplicates':
+        md = find_duplicates([directory], jobs=jobs)
+        result['duplicate_groups'] = len(md)
+        result['duplicates'] = sum(len(v) - 1 for v in md.values())
+    else:
+        pool = ExiftoolPool(workers=jobs, executable=exiftool)
+        if name == 'dates':
+            path_dates = photorg.photorg.date_sorted_paths(directory, exiftool=pool, jobs=jobs)
+            result['dated'] = len(path_dates)
+        else:
+            dest = tempfile.mkdtemp(prefix='bench_suite_')
+            photorg.photorg.organize_by_event(directory, dest, rename=True, exiftool=pool, jobs=jobs, copy_jobs=jobs)
+            result['copied'] = sum(1 for p in ls(dest, hidden=False, isfile=True))
+        pool.close()
+
+    elapsed = time.perf_counter() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    end_io = proc_io()
+    if dest:
+        shutil.rmtree(dest)
+
+    stats = {
+        'seconds': round(elapsed, 4),
+        'files': len(paths),
+        'bytes': size,
+        'files_per_sec': round(len(paths) / elapsed, 1) if elapsed else None,
+        'mb_per_sec': round(size / float(1 << 20) / elapsed, 2) if elapsed else None,
+        'user_seconds': round(end_usage.ru_utime - usage.ru_utime, 3),
+        'system_seconds': round(end_usage.ru_stime - usage.ru_stime, 3),
+        'children_cpu_seconds': round(end_children.ru_utime + end_children.ru_stime - children.ru_utime - children.ru_stime, 3),
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': round(end_usage.ru_maxrss / 1024.0, 1),
+        'children_peak_rss_mb': round(end_children.ru_maxrss / 1024.0, 1),
+        'voluntary_switches': end_usage.ru_nvcsw - usage.ru_nvcsw,
+        'result': result,
+    }
+    for key in ('syscr', 'syscw', 'read_bytes', 'write_bytes'):
+        if key in io:
+            stats[key] = end_io[key] - io[key]
+    return stats
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old):
+    """print the time of each phase relative to old results"""
+    print('{0:<12} {1:>10} {2:>10} {3:>8}'.format('phase', 'old s', 'new s', 'speedup'))
+    for name,stats in results['phases'].items():
+        before = old['phases'].get(name)
+        if not before:
+            continue
+        if before['result'] != stats['result']:
+            print('{0}: results differ: {1} != {2}'.format(name, before['result'], stats['result']))
+        print('{0:<12} {1:>10.3f} {2:>10.3f} {3:>7.2f}x'.format(name, before['seconds'], stats['seconds'], before['seconds'] / stats['seconds']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=None, help='benchmark this tree, generating it first if it does not exist (default a temporary tree)')
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=PHASES)
+    parser.add_argument('--jobs', type=int, default=1, help='threads and exiftool workers (default 1)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per phase; the fastest is kept')
+    parser.add_argument('--cold', action='store_true', help='drop the tree from the page cache before each run')
+    parser.add_argument('--tools', choices=['auto', 'stub', 'real'], default='auto', help='use the stub exiftool and ffprobe (default: only if not installed)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--run-phase', default=None, help=argparse.SUPPRESS)
+    corpus.add_arguments(parser)
+    args = parser.parse_args()
+
+    from photorg.exiftool import EXIFTOOL
+    from photorg.photorg import FFPROBE
+    exiftool = tool('exiftool', EXIFTOOL, args.tools)
+    ffprobe = tool('ffprobe', FFPROBE, args.tools)
+
+    if args.run_phase:
+        print(json.dumps(run_phase(args.run_phase, args.corpus, args.jobs, exiftool, ffprobe)))
+        return
+
+    directory = args.corpus or tempfile.mkdtemp(prefix='bench_corpus_')
+    options = corpus.corpus_options(args)
+    if args.corpus and os.path.exists(args.corpus):
+        sys.stderr.write('Using existing tree {0}; corpus options are not checked\n'.format(directory))
+        summary = None
+    else:
+        sys.stderr.write('Generating {0} files in {1}\n'.format(args.files, directory))
+        summary = corpus.generate(directory, **options)
+
+    results = {
+        'version': version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'exiftool': exiftool,
+        'ffprobe': ffprobe,
+        'jobs': args.jobs,
+        'cold': args.cold,
+        'corpus': dict(options, summary=summary),
+        'phases': {},
+    }
+    try:
+        for name in args.phases:
+            best = None
+            for i in range(args.repeat):
+                if args.cold:
+                    drop_cache(directory)
+                cmd = [sys.executable, os.path.abspath(__file__), '--run-phase', name, '--corpus', directory,
+                       '--jobs', str(args.jobs), '--tools', args.tools]
+                stats = json.loads(subprocess.check_output(cmd))
+                if best is None or stats['seconds'] < best['seconds']:
+                    best = stats
+            results['phases'][name] = best
+            sys.stderr.write('{0:<12} {1:>8.3f}s {2:>9.1f} files/s {3:>8.2f} MB/s {4:>7.1f} MB RSS {5}\n'.format(
+                name, best['seconds'], best['files_per_sec'], best['mb_per_sec'], best['peak_rss_mb'], best['result']))
+    finally:
+        if not args.corpus:
+            shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic camera import tree for benchmarks, offline and reproducibly from --seed.
+
+    python3 benchmarks/corpus.py /tmp/corpus --files 2000 --duplicate-ratio 0.1
+
+Photos are JPEG files with an EXIF APP1 segment (DateTimeOriginal, CreateDate) and random scan data.
+Videos are MP4 files whose mvhd box holds the creation time, followed by random media data.
+Files are laid out like camera cards (DCIM/100CANON/IMG_0001.JPG) in trips separated by quiet weeks,
+and their mtimes are set to the capture time.
+  --duplicate-ratio : fraction of files that are byte copies of an earlier file under another path
+  --collision-ratio : fraction of files that reuse the name of an earlier file from the same day with other content
+  --undated-ratio   : fraction of photos without EXIF dates
+Sizes follow a log-normal distribution around --size-median KB.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import struct
+import random
+import argparse
+from datetime import datetime, timedelta
+
+FILES_PER_FOLDER = 400
+
+# seconds between 1904-01-01, the QuickTime epoch, and 1970-01-01
+QUICKTIME_EPOCH = 2082844800
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little') if size else b''
+
+
+def exif_segment(date):
+    """APP1 segment with a little-endian TIFF header, IFD0 pointing at an Exif IFD with DateTimeOriginal and CreateDate"""
+    date_str = date.strftime('%Y:%m:%d %H:%M:%S').encode() + b'\0'
+    # TIFF header (8), IFD0 with 1 entry (18), Exif IFD with 2 entries (30), two date strings
+    exif_ifd = 8 + 18
+    data = exif_ifd + 30
+    tiff = b'II*\0' + struct.pack('<I', 8)
+    tiff += struct.pack('<H', 1) + struct.pack('<HHII', 0x8769, 4, 1, exif_ifd) + struct.pack('<I', 0)
+    tiff += struct.pack('<H', 2)
+    tiff += struct.pack('<HHII', 0x9003, 2, len(date_str), data)
+    tiff += struct.pack('<HHII', 0x9004, 2, len(date_str), data + len(date_str))
+    tiff += struct.pack('<I', 0)
+    tiff += date_str + date_str
+    body = b'Exif\0\0' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(body) + 2) + body
+
+
+def jpeg(date, payload):
+    """a JPEG file: SOI, EXIF (if date), a minimal SOS header, payload as scan data, EOI"""
+    sos = b'\xff\xda' + struct.pack('>HBBBBBB', 8, 1, 1, 0, 0, 63, 0)
+    return b'\xff\xd8' + (exif_segment(date) if date else b'') + sos + payload + b'\xff\xd9'
+
+
+def box(kind, body):
+    return struct.pack('>I', len(body) + 8) + kind + body
+
+
+def mp4(date, payload):
+    """an MP4 file: ftyp, moov with an mvhd holding the creation time (0 if no date), mdat"""
+    created = int((date - datetime(1970, 1, 1)).total_seconds()) + QUICKTIME_EPOCH if date else 0
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    mvhd = struct.pack('>IIIII', 0, created, created, 1000, 0) + struct.pack('>IH', 0x10000, 0x100) + b'\0' * 10 + matrix + b'\0' * 24 + struct.pack('>I', 2)
+    return box(b'ftyp', b'isom' + struct.pack('>I', 0x200) + b'isommp41') + box(b'moov', box(b'mvhd', mvhd)) + box(b'mdat', payload)
+
+
+def capture_dates(rng, count):
+    """capture times for count files, in trips of a few days separated by 5-30 quiet days"""
+    dates = []
+    day = datetime(2015, 1, 1)
+    while len(dates) < count:
+        day += timedelta(days=rng.randint(5, 30))
+        trip = timedelta(days=rng.randint(1, 3))
+        for i in range(min(rng.randint(10, 300), count - len(dates))):
+            dates.append(day + timedelta(seconds=rng.randint(0, int(trip.total_seconds()))))
+    return sorted(dates)
+
+
+def generate(directory, files=1000, video_ratio=0.1, size_median=256, size_sigma=1.0, duplicate_ratio=0.1,
+             collision_ratio=0.05, undated_ratio=0.02, seed=0):
+    """write the corpus to directory and return a summary dict"""
+    rng = random.Random(seed)
+    dates = capture_dates(rng, files)
+    written = []
+    by_day = {}
+    summary = {'files': 0, 'bytes': 0, 'photos': 0, 'videos': 0, 'duplicates': 0, 'collisions': 0, 'undated': 0}
+
+    for n,date in enumerate(dates):
+        folder = os.path.join(directory, 'DCIM', '{0}CANON'.format(100 + n // FILES_PER_FOLDER))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        r = rng.random()
+
+        if written and r < duplicate_ratio:
+            # byte copy of an earlier file, as left behind by a second import
+            source, name = rng.choice(written)
+            with open(source, 'rb') as f:
+                data = f.read()
+            name = 'COPY_{0:04d}{1}'.format(n % 10000, os.path.splitext(name)[1])
+            summary['duplicates'] += 1
+        else:
+            video = rng.random() < video_ratio
+            size = max(1024, int(rng.lognormvariate(math.log(size_median * 1024), size_sigma)))
+            dated = video or rng.random() >= undated_ratio
+            payload = random_bytes(rng, size)
+            data = mp4(date, payload) if video else jpeg(date if dated else None, payload)
+            name = '{0}_{1:04d}.{2}'.format('MVI' if video else 'IMG', n % 10000, 'MP4' if video else 'JPG')
+            day = by_day.get(date.date())
+            if day and r < duplicate_ratio + collision_ratio:
+                # another camera numbered a different picture the same on the same day
+                name = rng.choice(day)
+                summary['collisions'] += 1
+            summary['videos' if video else 'photos'] += 1
+            summary['undated'] += not dated
+
+        path = os.path.join(folder, name)
+        while os.path.exists(path):
+            name = 'DUP_{0}'.format(name)
+            path = os.path.join(folder, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        stamp = time.mktime(date.timetuple())
+        os.utime(path, (stamp, stamp))
+        written.append((path, name))
+        by_day.setdefault(date.date(), []).append(name)
+        summary['files'] += 1
+        summary['bytes'] += len(data)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='output directory, created if needed')
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(json.dumps(generate(args.directory, **corpus_options(args)), indent=1))
+
+
+def add_arguments(parser):
+    parser.add_argument('--files', type=int, default=1000, help='number of files (default 1000)')
+    parser.add_argument('--video-ratio', type=float, default=0.1, help='fraction of videos (default 0.1)')
+    parser.add_argument('--size-median', type=int, default=256, help='median file size in KB (default 256)')
+    parser.add_argument('--size-sigma', type=float, default=1.0, help='log-normal sigma of file sizes (default 1.0)')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help='fraction of byte copies (default 0.1)')
+    parser.add_argument('--collision-ratio', type=float, default=0.05, help='fraction of same-day name collisions (default 0.05)')
+    parser.add_argument('--undated-ratio', type=float, default=0.02, help='fraction of photos without EXIF dates (default 0.02)')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def corpus_options(args):
+    return dict(files=args.files, video_ratio=args.video_ratio, size_median=args.size_median, size_sigma=args.size_sigma,
+                duplicate_ratio=args.duplicate_ratio, collision_ratio=args.collision_ratio, undated_ratio=args.undated_ratio, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,12 @@
 from __future__ import absolute_import
 from .photorg import *
 from .deduplicate import *
+from .cache import *
+from .exiftool import *
+from .plan import *
+from .manifest import *
+from .events import *
+from .watch import *
+from .metrics import *
+from .similar import *
+from .payload import *
@@ -0,0 +1,223 @@
+"""
+persistent sha1 digest, metadata and image hash caches
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger('photorg')
+
+
+def default_cache_path(name='digests.sqlite'):
+    """return path to name in the user cache directory ($XDG_CACHE_HOME/photorg or ~/.cache/photorg)"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'photorg', name)
+
+
+class SqliteCache(object):
+    """
+    common base of the SQLite backed caches.
+    Writes are committed every commit_interval changes and on close().
+    Safe to share between threads.
+    """
+    name = 'cache'
+    schema = None
+
+    def __init__(self, path=None, commit_interval=1000):
+        self.path = path or default_cache_path(self.name + '.sqlite')
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o755)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.execute(self.schema)
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def changed(self):
+        """count a pending write and commit if enough have accumulated"""
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def compact(self):
+        """reclaim unused space in the cache file"""
+        self.commit()
+        with self.lock:
+            self.db.execute("VACUUM")
+
+    def close(self):
+        self.commit()
+        self.db.close()
+        logger.info("{0} cache: {1} hits, {2} misses".format(self.name.capitalize(), self.hits, self.misses))
+
+
+class DigestCache(SqliteCache):
+    """
+    SQLite backed cache of sha1 digests.
+    Entries are keyed on (st_dev, st_ino) and are only valid while st_size and st_mtime_ns match.
+    Stale entries are replaced the next time the file is hashed.
+    The path is stored only so entries for deleted files can be evicted.
+    """
+    name = 'digests'
+    schema = """CREATE TABLE IF NOT EXISTS digests (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, path TEXT, sha1 TEXT,
+            PRIMARY KEY (dev, ino))"""
+
+    def get(self, st):
+        """return the cached digest for stat result st, or None if missing or stale"""
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, sha1 FROM digests WHERE dev=? AND ino=?",
+                    (st.st_dev, st.st_ino)).fetchone()
+            if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                self.hits += 1
+                return row[2]
+            self.misses += 1
+            return None
+
+    def put(self, path, st, digest):
+        """store digest of path with stat result st, replacing any stale entry"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                    (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, path, digest))
+            self.changed()
+
+    def evict(self):
+        """remove entries whose path no longer exists or no longer refers to the cached inode"""
+        stale = []
+        with self.lock:
+            rows = self.db.execute("SELECT dev, ino, path FROM digests").fetchall()
+        for dev, ino, path in rows:
+            try:
+                st = os.stat(path)
+                if (st.st_dev, st.st_ino) == (dev, ino):
+                    continue
+            except OSError:
+                pass
+            stale.append((dev, ino))
+        with self.lock:
+            self.db.executemany("DELETE FROM digests WHERE dev=? AND ino=?", stale)
+        self.commit()
+        logger.info("Evicted {0} stale digest cache entries".format(len(stale)))
+        return len(stale)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+
+
+class ImageHashCache(SqliteCache):
+    """
+    SQLite backed cache of perceptual image hashes, see similar.dhash().
+    Entries are keyed on (st_dev, st_ino) and the hash kind, and are only valid while st_size and st_mtime_ns match.
+    Hashes are stored as hex, since 64 bit hashes do not fit SQLite's signed integers.
+    """
+    name = 'imagehashes'
+    schema = """CREATE TABLE IF NOT EXISTS imagehashes (
+            dev INTEGER, ino INTEGER, kind TEXT, size INTEGER, mtime_ns INTEGER, path TEXT, hash TEXT,
+            PRIMARY KEY (dev, ino, kind))"""
+
+    def __init__(self, path=None, commit_interval=1000, kind='dhash8'):
+        SqliteCache.__init__(self, path, commit_interval)
+        self.kind = kind
+
+    def get(self, st):
+        """return the cached hash for stat result st, or None if missing or stale"""
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, hash FROM imagehashes WHERE dev=? AND ino=? AND kind=?",
+                    (st.st_dev, st.st_ino, self.kind)).fetchone()
+            if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                self.hits += 1
+                return int(row[2], 16)
+            self.misses += 1
+            return None
+
+    def put(self, path, st, value):
+        """store hash value of path with stat result st, replacing any stale entry"""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO imagehashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (st.st_dev, st.st_ino, self.kind, st.st_size, st.st_mtime_ns, path, '{0:x}'.format(value)))
+            self.changed()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM imagehashes").fetchone()[0]
+
+
+class MetadataCache(SqliteCache):
+    """
+    SQLite backed cache of resolved capture dates.
+    Entries are keyed on path and are only valid while st_size and st_mtime_ns match.
+    date is None for files which were examined and have no date metadata.
+    source records which tool produced the date (exiftool, ffprobe).
+    At most max_entries are kept; the least recently used entries are evicted on close().
+    """
+    name = 'metadata'
+    schema = """CREATE TABLE IF NOT EXISTS metadata (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, date TEXT, source TEXT, used REAL)"""
+
+    def __init__(self, path=None, commit_interval=1000, max_entries=1000000):
+        SqliteCache.__init__(self, path, commit_interval)
+        self.max_entries = max_entries
+        self.used = []
+
+    def get(self, path, st=None):
+        """return (date, source) for path, or None if missing or stale"""
+        st = st or os.stat(path)
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, date, source FROM metadata WHERE path=?", (path,)).fetchone()
+            if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+                self.hits += 1
+                self.used.append(path)
+                date = datetime.strptime(row[2], '%Y-%m-%d %H:%M:%S.%f') if row[2] else None
+                return date, row[3]
+            self.misses += 1
+            return None
+
+    def put(self, path, date, source, st=None):
+        """store date of path as produced by source, replacing any stale entry"""
+        st = st or os.stat(path)
+        date_str = date.strftime('%Y-%m-%d %H:%M:%S.%f') if date else None
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, st.st_size, st.st_mtime_ns, date_str, source, time.time()))
+            self.changed()
+
+    def commit(self):
+        with self.lock:
+            # record use of cache hits in bulk rather than one write per hit
+            now = time.time()
+            self.db.executemany("UPDATE metadata SET used=? WHERE path=?", ((now, path) for path in self.used))
+            self.used = []
+            SqliteCache.commit(self)
+
+    def evict(self, max_entries=None):
+        """remove the least recently used entries beyond max_entries"""
+        max_entries = self.max_entries if max_entries is None else max_entries
+        self.commit()
+        with self.lock:
+            excess = len(self) - max_entries
+            if excess > 0:
+                self.db.execute("DELETE FROM metadata WHERE path IN (SELECT path FROM metadata ORDER BY used LIMIT ?)", (excess,))
+                self.commit()
+                logger.info("Evicted {0} metadata cache entries".format(excess))
+        return max(excess, 0)
+
+    def close(self):
+        self.evict()
+        SqliteCache.close(self)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
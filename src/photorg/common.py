@@ -4,25 +4,234 @@ common utility functions
 """
 
 import os
+import sys
+import mmap
+import time
 import logging
 import hashlib
-from shutil import copyfile
+import errno
+import fcntl
+import threading
+from stat import S_ISREG
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import METRICS
+from .payload import payload_sha1
 
 logger = logging.getLogger('photorg')
 
 
-def sha1(path, blocksize=4096):
-    """return the sha1 hex digest of path"""
-    with open(path, 'rb') as f:
-        block = f.read(blocksize)
-        sha = hashlib.sha1()
-        while block:
-            sha.update(block)
-            block = f.read(blocksize)
-        digest = sha.hexdigest()
+# optional persistent digest cache used by sha1(); see set_digest_cache()
+DIGEST_CACHE = None
+
+
+def set_digest_cache(cache):
+    """enable (or disable with None) the persistent digest cache for all sha1() calls"""
+    global DIGEST_CACHE
+    DIGEST_CACHE = cache
+
+
+# what sha1() hashes: 'file' for whole files, 'payload' for image and video data only; see set_digest_mode()
+DIGEST_MODE = 'file'
+DIGEST_MODES = ('file', 'payload')
+
+
+def set_digest_mode(mode):
+    """
+    select what sha1() hashes for all collision checks and deduplication.
+    'payload' hashes only the image or video data (see payload_sha1()), so copies which differ only in metadata
+    are the same file. Payload digests are not cached, since the digest cache holds whole file digests.
+    """
+    global DIGEST_MODE
+    if mode not in DIGEST_MODES:
+        raise ValueError('Unknown digest mode: {0}'.format(mode))
+    DIGEST_MODE = mode
+
+
+def payload_mode():
+    return DIGEST_MODE == 'payload'
+
+
+# sha1_file() strategy defaults, measured with benchmarks/bench_sha1.py:
+# readinto with 64 KiB blocks was fastest for small files, a single mmap update() from 16 MiB up
+READ_BUFFER_SIZE = 1 << 16
+MMAP_THRESHOLD = 16 << 20
+HASH_STRATEGIES = ('read', 'readinto', 'mmap')
+
+# reusable per-thread read buffers for sha1_file()
+_buffers = threading.local()
+
+
+def sha1(path, blocksize=None, st=None):
+    """
+    return the sha1 hex digest of path, from the digest cache if enabled and current
+    st : stat result of path if already known, e.g. from scan()
+    in payload mode, return payload_sha1(path) instead, see set_digest_mode()
+    """
+    if DIGEST_MODE == 'payload':
+        return payload_sha1(path)
+    if DIGEST_CACHE is None:
+        return sha1_file(path, blocksize)
+    st = st or os.stat(path)
+    digest = DIGEST_CACHE.get(st)
+    if digest is None:
+        digest = sha1_file(path, blocksize)
+        DIGEST_CACHE.put(path, st, digest)
     return digest
 
 
+def fadvise(fd, advice):
+    """posix_fadvise the whole file, where supported"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+
+def read_buffer(size):
+    """return a reusable memoryview of at least size bytes for the current thread"""
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = memoryview(bytearray(size))
+        _buffers.buf = buf
+    return buf[:size]
+
+
+def sha1_file(path, blocksize=None, strategy=None, dontneed=True):
+    """
+    return the sha1 hex digest of path by reading the whole file
+    blocksize : read size, default READ_BUFFER_SIZE
+    strategy : one of HASH_STRATEGIES, default mmap for files of at least MMAP_THRESHOLD bytes, else readinto
+     - read : plain f.read() calls, a new bytes object per block
+     - readinto : readinto() a reusable buffer, hashed through a memoryview without copying
+     - mmap : map the file and hash it with a single update() call
+    dontneed : drop the file from the page cache afterwards so bulk scans don't evict more useful pages
+    """
+    blocksize = blocksize or READ_BUFFER_SIZE
+    sha = hashlib.sha1()
+    start = time.monotonic()
+    with open(path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        if strategy is None:
+            strategy = 'mmap' if size >= MMAP_THRESHOLD else 'readinto'
+        if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+            fadvise(fd, os.POSIX_FADV_SEQUENTIAL)
+
+        if strategy == 'mmap' and size > 0:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                sha.update(mm)
+
+        elif strategy == 'read':
+            block = f.read(blocksize)
+            while block:
+                sha.update(block)
+                block = f.read(blocksize)
+
+        else:
+            buf = read_buffer(blocksize)
+            n = f.readinto(buf)
+            while n:
+                sha.update(buf[:n])
+                n = f.readinto(buf)
+
+        if dontneed and hasattr(os, 'POSIX_FADV_DONTNEED'):
+            fadvise(fd, os.POSIX_FADV_DONTNEED)
+    METRICS.observe('sha1', time.monotonic() - start, path)
+    METRICS.count('bytes_read', size)
+    return sha.hexdigest()
+
+
+def sha1_sample(path, size=None, blocksize=65536, st=None):
+    """
+    return the sha1 hex digest of the first and last blocksize bytes of path.
+    Files no larger than two blocks are hashed in full, so the digest equals sha1(path).
+    Only useful for comparing files of the same size, and in the 'file' digest mode.
+    st : stat result of path if already known, see sha1()
+    """
+    if size is None:
+        size = (st or os.stat(path)).st_size
+    if size <= 2 * blocksize:
+        return sha1(path, st=st)
+    with open(path, 'rb') as f:
+        sha = hashlib.sha1(f.read(blocksize))
+        f.seek(size - blocksize)
+        sha.update(f.read(blocksize))
+    METRICS.count('bytes_read', 2 * blocksize)
+    return sha.hexdigest()
+
+
+class DeviceLimiter(object):
+    """
+    limit the number of concurrent operations per device (st_dev).
+    e.g. limit=1 serializes reads from each spinning disk while still reading different disks in parallel
+    stats : dict of known stat results by path, e.g. from scan(); other paths are stat'ed
+    """
+    def __init__(self, limit=None, stats=None):
+        self.limit = limit
+        self.stats = stats or {}
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def semaphore(self, path):
+        st = self.stats.get(path)
+        dev = (st or os.stat(path)).st_dev
+        with self.lock:
+            if dev not in self.semaphores:
+                self.semaphores[dev] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[dev]
+
+    def run(self, func, path):
+        if not self.limit:
+            return func(path)
+        with self.semaphore(path):
+            return func(path)
+
+
+def hash_map(paths, func=None, jobs=1, per_device=None, stats=None):
+    """
+    yield (path, func(path)) for each path in paths, in the same order as paths.
+    func : hash function, default sha1
+    jobs : number of files hashed concurrently (hashlib releases the GIL, so threads are sufficient)
+    per_device : maximum concurrent reads per device, default unlimited
+    stats : stat results by path, used to find the device of each path, see DeviceLimiter
+    At most jobs*4 files are queued ahead of the consumer, so paths may be a lazy iterator.
+    """
+    func = func or sha1
+    if jobs <= 1:
+        for path in paths:
+            yield path, func(path)
+        return
+
+    limiter = DeviceLimiter(per_device, stats)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for path in paths:
+            pending.append((path, executor.submit(limiter.run, func, path)))
+            # bounded queue: wait for the oldest result before submitting more
+            if len(pending) >= jobs * 4:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def batches(iterable, size):
+    """yield lists of up to size items from iterable"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 #def shasums(path):
 #    """walk directory and yield (sha1(path), path)"""
 #    for base,dirs,files in os.walk(source):
@@ -50,43 +259,108 @@ def realpath(p):
 
 
 
-def ls(path, relative=True, hidden=True, recursive=True, isfile=False):
+class FileEntry(object):
     """
-    walk directory and yield paths to files
-    files : only include regular files, ignore symlinks, etc.
-    recursive : decend into children directories
-    hidden : whether or not to include hidden files
-
+    a file found by scan(): its path and stat result.
+    The stat result is taken while scanning or on first use, then kept, so each file is stat'ed once per run.
     """
-    base = realpath(path) 
+    __slots__ = ('path', 'st')
 
-    for root, dirs, files in os.walk(base, topdown=True):
+    def __init__(self, path, st=None):
+        self.path = path
+        self.st = st
 
-        # skip hidden directories
-        for dname in dirs:
-            if not hidden and dname.startswith('.'):
-                dirs.remove(dname)
+    def stat(self):
+        if self.st is None:
+            self.st = os.stat(self.path)
+        return self.st
 
-        for name in files:
-            path = os.path.join(root,name)
+    def __repr__(self):
+        return 'FileEntry({0!r})'.format(self.path)
 
-            # skip hidden files 
-            if not hidden and name.startswith('.'):
-                continue
 
-            # skop non-regular files
-            if isfile and not os.path.isfile(path):
+def scan_dir(directory, hidden=True, isfile=False, stat=False):
+    """
+    list one directory with os.scandir and return (FileEntry list, subdirectory paths) in directory order.
+    Symlinks to directories are neither listed nor followed, as with os.walk; unreadable directories are skipped.
+    """
+    files = []
+    dirs = []
+    try:
+        it = os.scandir(directory)
+    except OSError as e:
+        logger.warning("Can not list {0}: {1}".format(directory, e.strerror))
+        return files, dirs
+    with it:
+        for entry in it:
+            if not hidden and entry.name.startswith('.'):
                 continue
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                    continue
+                # the file type comes from the directory listing; only stat if asked or needed for a symlink
+                st = entry.stat() if stat else None
+            except OSError:
+                # vanished or a dangling symlink
+                if isfile:
+                    continue
+                st = None
+            if isfile and not (S_ISREG(st.st_mode) if st is not None else entry.is_file()):
+                continue
+            files.append(FileEntry(entry.path, st))
+    return files, dirs
 
-            if relative:
-                yield os.path.relpath(path, base)
 
-            else:
-                yield path
+def scan(path, hidden=True, recursive=True, isfile=False, stat=False, jobs=1):
+    """
+    walk directory and yield a FileEntry for each file, in the same order as os.walk (top down, directory order)
+    isfile : only include regular files and symlinks to them
+    recursive : decend into children directories
+    hidden : whether or not to include hidden files and directories
+    stat : stat each file while scanning, e.g. to use its size, inode or mtime later without another stat
+    jobs : number of directories listed concurrently; listings are read ahead of the consumer,
+        which hides the latency of network filesystems. The order does not depend on jobs.
+    """
+    base = realpath(path)
+    list_dir = lambda d: scan_dir(d, hidden, isfile, stat)
+
+    if jobs <= 1:
+        stack = [base]
+        while stack:
+            files, dirs = list_dir(stack.pop())
+            for entry in files:
+                yield entry
+            if recursive:
+                stack.extend(reversed(dirs))
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        stack = [executor.submit(list_dir, base)]
+        while stack:
+            files, dirs = stack.pop().result()
+            for entry in files:
+                yield entry
+            # submit all subdirectories at once, so sibling subtrees are listed while this one is consumed
+            if recursive:
+                stack.extend(reversed([executor.submit(list_dir, d) for d in dirs]))
+
+
+def ls(path, relative=True, hidden=True, recursive=True, isfile=False):
+    """
+    walk directory and yield paths to files
+    files : only include regular files, ignore symlinks, etc.
+    recursive : decend into children directories
+    hidden : whether or not to include hidden files
+    see scan() for entries with stat results
+    """
+    base = realpath(path)
+    # paths below base, without base and its separator
+    cut = len(base.rstrip('/')) + 1
+    for entry in scan(base, hidden=hidden, recursive=recursive, isfile=isfile):
+        yield entry.path[cut:] if relative else entry.path
 
-        # exit after first loop if not recursive
-        if not recursive:
-            break
 
 
 class multidict(dict):
@@ -98,12 +372,188 @@ class multidict(dict):
 
 
 
+class Progress(object):
+    """
+    show count of files and bytes done, and throughput, on a single stderr line.
+    Safe to update from worker threads.
+    """
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.count = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.shown = 0
+        self.lock = threading.Lock()
+
+    def update(self, count=1, size=0):
+        with self.lock:
+            self.count += count
+            self.bytes += size
+            now = time.monotonic()
+            # redraw at most a few times per second
+            if now - self.shown < 0.25 and self.count < self.total:
+                return
+            self.shown = now
+            elapsed = max(now - self.start, 1e-6)
+            mb = self.bytes / float(1 << 20)
+            # use carriage return to update terminal line
+            self.stream.write("\r{0}/{1} files, {2:.1f} MB, {3:.1f} MB/s    ".format(self.count, self.total, mb, mb / elapsed))
+            self.stream.flush()
+
+    def close(self):
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+
 class FileCollisionError(Exception):
+    """destination exists with different content; digest is the sha1() of the source if it was computed"""
+    def __init__(self, message, digest=None):
+        Exception.__init__(self, message)
+        self.digest = digest
+
+
+class CopyVerificationError(Exception):
     pass
 
 
 
-def copy_file(source, target, hardlink=False, delete=False):
+# ioctl to clone (reflink) a file on btrfs, XFS and other copy-on-write filesystems; _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning a copy method is unsupported for this pair of files, so the next method should be tried;
+# ENODATA is raised by the in-kernel methods when they copy nothing before the expected size
+COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.ENODATA)
+
+
+def copy_reflink(src, dst, size):
+    fcntl.ioctl(dst, FICLONE, src)
+
+
+def copy_incomplete(method, left):
+    """error for an in-kernel copy which stopped early, e.g. on FUSE or procfs-like files, or a source truncated meanwhile"""
+    return OSError(errno.ENODATA, '{0} stopped with {1} bytes left'.format(method, left))
+
+
+def copy_range(src, dst, size):
+    while size > 0:
+        n = os.copy_file_range(src, dst, size)
+        if n == 0:
+            raise copy_incomplete('copy_file_range', size)
+        size -= n
+
+
+def copy_sendfile(src, dst, size):
+    offset = 0
+    while offset < size:
+        n = os.sendfile(dst, src, offset, size - offset)
+        if n == 0:
+            raise copy_incomplete('sendfile', size - offset)
+        offset += n
+
+
+def write_all(fd, data):
+    """write all of data to fd, continuing after short writes"""
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def copy_userspace(src, dst, size):
+    buf = read_buffer(READ_BUFFER_SIZE)
+    n = os.readv(src, [buf])
+    while n:
+        write_all(dst, buf[:n])
+        n = os.readv(src, [buf])
+
+
+# cheapest first: shared extents, in-kernel copy, in-kernel copy through the page cache, read/write
+COPY_METHODS = [('reflink', copy_reflink), ('copy_file_range', copy_range), ('sendfile', copy_sendfile), ('userspace', copy_userspace)]
+if not hasattr(os, 'copy_file_range'):
+    COPY_METHODS.remove(('copy_file_range', copy_range))
+
+
+def copy_data(source, target):
+    """
+    copy the content of source to target, which must not exist, using the cheapest method that works.
+    A method which is unsupported or stops before the size of source is discarded and the next one tried;
+    the userspace copy reads source to its end.
+    target is created exclusively, so an existing file is never overwritten, and removed again if the copy fails.
+    returns the name of the method used
+    """
+    start = time.monotonic()
+    with open(source, 'rb', buffering=0) as fsrc:
+        src = fsrc.fileno()
+        size = os.fstat(src).st_size
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            for name,method in COPY_METHODS:
+                try:
+                    method(src, dst, size)
+                    METRICS.observe('copy', time.monotonic() - start, source)
+                    METRICS.count('bytes_read', size)
+                    METRICS.count('bytes_written', size)
+                    return name
+                except OSError as e:
+                    if e.errno not in COPY_UNSUPPORTED or name == 'userspace':
+                        raise
+                    # discard any partial copy and try the next method
+                    os.ftruncate(dst, 0)
+                    os.lseek(dst, 0, os.SEEK_SET)
+                    os.lseek(src, 0, os.SEEK_SET)
+        except BaseException:
+            os.close(dst)
+            dst = None
+            os.unlink(target)
+            raise
+        finally:
+            if dst is not None:
+                os.close(dst)
+
+
+
+def copy_data_verified(source, target):
+    """
+    copy the content of source to target, which must not exist, hashing the data as it is copied.
+    target is then flushed to disk, dropped from the page cache and read back, 
+    and removed with CopyVerificationError if its digest differs.
+    returns the sha1 hex digest
+    """
+    sha = hashlib.sha1()
+    buf = read_buffer(READ_BUFFER_SIZE)
+    start = time.monotonic()
+    size = 0
+    with open(source, 'rb', buffering=0) as fsrc:
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            n = fsrc.readinto(buf)
+            while n:
+                sha.update(buf[:n])
+                write_all(dst, buf[:n])
+                size += n
+                n = fsrc.readinto(buf)
+            os.fsync(dst)
+            if hasattr(os, 'POSIX_FADV_DONTNEED'):
+                fadvise(dst, os.POSIX_FADV_DONTNEED)
+        except BaseException:
+            os.close(dst)
+            os.unlink(target)
+            raise
+        os.close(dst)
+    METRICS.count('bytes_read', size)
+    METRICS.count('bytes_written', size)
+
+    # the read back is observed as sha1
+    digest = sha.hexdigest()
+    if sha1_file(target) != digest:
+        os.unlink(target)
+        raise CopyVerificationError('Destination file does not match data read from source: {src}, {dest}\n'.format(src=source, dest=target))
+    METRICS.observe('copy', time.monotonic() - start, source)
+    return digest
+
+
+
+def copy_file(source, target, hardlink=False, delete=False, verify=False, keep_dir=None, digest=None):
     """
     Copy file safely
      - don't overwrite existing destination files
@@ -111,12 +561,20 @@ def copy_file(source, target, hardlink=False, delete=False):
      - create destination directories as needed
      - as idempotent as possible
     hardlink on Linux: first try to hard-link. If that fails, perform regular copy.
+    verify : hash data while copying and compare with the destination read back from disk, see copy_data_verified()
+    keep_dir : directory which is not removed when delete leaves it empty, e.g. a watched inbox
+    digest : sha1() of source if already known, used instead of hashing it again for the collision check
+    returns the sha1 digest of the file, as sha1() computes it, if it was computed or given, otherwise None.
+    The digest is also recorded in the digest cache, if enabled.
     """
 
     # first make sure that the source path exists:
     if not os.path.isfile(source):
         raise Exception('File does not exist (or is not a regular file): ' + source)
 
+    # whether target is known to hold the same bytes as source, rather than only the same payload
+    identical = True
+
     target_dir = os.path.dirname(target)
     target_path = target
 
@@ -132,16 +590,18 @@ def copy_file(source, target, hardlink=False, delete=False):
         # can safely skip if same inode
         if not os.path.samefile(source, target_path):
 
-            # compare sizes
-            if os.stat(source).st_size == os.stat(target_path).st_size:
+            # compare sizes; in payload mode files with different metadata differ in size but may be the same
+            if os.stat(source).st_size == os.stat(target_path).st_size or DIGEST_MODE == 'payload':
 
                 # compare hash
-                if sha1(source) != sha1(target_path):
-                    raise FileCollisionError('Destination file exists but has different hash: {src}, {dest}\n'.format(src=source, dest=target_path))
+                digest = digest or sha1(source)
+                if digest != sha1(target_path):
+                    raise FileCollisionError('Destination file exists but has different hash: {src}, {dest}\n'.format(src=source, dest=target_path), digest)
+                identical = DIGEST_MODE != 'payload'
 
             # target file exists but has different size
             else:
-                raise FileCollisionError('Destination file exists and is different size: {src}, {dest}\n'.format(src=source, dest=target_path))
+                raise FileCollisionError('Destination file exists and is different size: {src}, {dest}\n'.format(src=source, dest=target_path), digest)
 
     # target does not already exist
     else:
@@ -150,29 +610,57 @@ def copy_file(source, target, hardlink=False, delete=False):
             try:
                 os.link(source, target_path)
                 logger.info("Hardlink: {t} -> {s}".format(s=source, t=target_path))
+                METRICS.count('files_linked')
 
             # if link fails, failback to copy
             except OSError as e:
                 logger.warning("Hardlink failed; copying instead")
-                #logger.warning("Copying: {s} --> {t}".format(s=source, t=target_path))
-                copyfile(source, target_path)
+                hardlink = False
 
         # copy
-        else:
-            logger.info("Copying: {s} --> {t}".format(s=source, t=target_path))
-            copyfile(source, target_path)
+        if not hardlink:
+            copied = None
+            if verify:
+                copied = copy_data_verified(source, target_path)
+                method = 'verified'
+            else:
+                method = copy_data(source, target_path)
+            logger.info("Copying ({m}): {s} --> {t}".format(m=method, s=source, t=target_path))
+            METRICS.count('files_copied')
+
+            # record digest for later collision checks and deduplication
+            if copied and DIGEST_CACHE is not None:
+                DIGEST_CACHE.put(target_path, os.stat(target_path), copied)
+
+            # the copied data was hashed in full, which is not the digest sha1() returns in payload mode
+            if DIGEST_MODE != 'payload':
+                digest = digest or copied
+
+    # a source which only matches the payload of the target keeps its own metadata, so it is only deleted if it is identical
+    if delete and not identical:
+        identical = sha1_file(source) == sha1_file(target_path)
+        if not identical:
+            logger.info("Keeping {0}: its metadata differs from {1}".format(source, target_path))
 
     # file was either copied or target already existed and was identical
     # can delete source, but first verify size just to be safe
-    if delete and (os.stat(source).st_size == os.stat(target_path).st_size):
+    if delete and identical and (os.stat(source).st_size == os.stat(target_path).st_size):
         logger.info("Deleting: {0}".format(source))
         os.unlink(source)
+        METRICS.count('files_deleted')
 
         # check for and remove empty directories
+        # another copy may have already removed it, or added a file to it
         dirnam = os.path.dirname(source)
-        if not os.listdir(dirnam):
-            logger.info("Deleting empty directory: {0}".format(dirnam))
-            os.rmdir(dirnam)
+        if dirnam != keep_dir:
+            try:
+                if not os.listdir(dirnam):
+                    logger.info("Deleting empty directory: {0}".format(dirnam))
+                    os.rmdir(dirnam)
+            except OSError as e:
+                logger.debug(str(e))
+
+    return digest
 
         
 
@@ -5,64 +5,224 @@ from __future__ import absolute_import
 import sys
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from .photorg import *
 from .common import *
+from .cache import DigestCache, ImageHashCache, default_cache_path
+from .manifest import Manifest, open_manifest
+from .similar import image_hash, similar_groups, SIMILAR_DISTANCE, HASH_SIZE
+from .events import is_event_index
+from . import similar
+from .metrics import METRICS, write_stats
 
 
-def sha1sums(directories):
-    """walk all directories and return a multidict keyed on sha1 digest"""
-    md = multidict()
-    # for each directory in directories
+SAMPLE_SIZE = 65536
+
+
+def scan_files(directories, scan_jobs=1):
+    """
+    walk all directories and return a dict of the stat result of each regular file, in sorted order per directory.
+    don't list paths more than once; this prevents accidentally deleting files if same dir specified more than once
+    photorg's event index files are left out, see EventIndex
+    scan_jobs : number of directories listed concurrently, see scan()
+    """
+    stats = {}
     for d in directories:
-        # list all files and sort
-        for path in sorted(ls(d, relative=False, isfile=True)):
-            digest = sha1(path)
-            # don't add paths to value list more than once
-            # this will prevent accidentally deleting files if same dir specified more than once
-            if (digest in md) and (path in md[digest]):
-                continue
-            else:
-                # append to multidict
-                md[digest] = path
+        for entry in sorted(scan(d, isfile=True, stat=True, jobs=scan_jobs), key=lambda entry: entry.path):
+            if entry.path not in stats and not is_event_index(entry.path):
+                stats[entry.path] = entry.st
+    return stats
+
+
+def scan_paths(directories, scan_jobs=1):
+    """walk all directories and yield each regular file once, in sorted order per directory, see scan_files()"""
+    for path in scan_files(directories, scan_jobs):
+        yield path
+
+
+def first_links(paths, sizes=None, stats=None):
+    """
+    map each path to the first path in paths with the same (st_dev, st_ino), so hardlinks of one file are read once
+    sizes : dict filled with the size of each path
+    stats : stat results by path, e.g. from scan_files(); other paths are stat'ed
+    """
+    first = {}
+    links = {}
+    for path in paths:
+        st = stats[path] if stats and path in stats else os.stat(path)
+        links[path] = first.setdefault((st.st_dev, st.st_ino), path)
+        if sizes is not None:
+            sizes[path] = st.st_size
+    return links
+
+
+def sha1sums(directories, jobs=1, per_device=None, scan_jobs=1):
+    """
+    walk all directories and return a multidict keyed on sha1 digest
+    hardlinks of one file are hashed once
+    jobs : number of files to hash concurrently; order of the result does not depend on jobs
+    per_device : maximum concurrent reads per device
+    scan_jobs : number of directories listed concurrently
+    Each file is stat'ed once, while scanning.
+    """
+    with METRICS.phase('enumerate'):
+        stats = scan_files(directories, scan_jobs)
+        paths = list(stats)
+        links = first_links(paths, stats=stats)
+    func = lambda path: sha1(path, st=stats[path])
+    with METRICS.phase('hash'):
+        digests = dict(hash_map([path for path in paths if links[path] == path], func, jobs=jobs, per_device=per_device, stats=stats))
+    METRICS.count('files_scanned', len(paths))
+    md = multidict()
+    for path in paths:
+        md[digests[links[path]]] = path
     return md
 
 
-def find_duplicates(directories):
+def find_duplicates(directories, samplesize=SAMPLE_SIZE, jobs=1, per_device=None, scan_jobs=1):
     """
     scan each dir in directories and return a multidict keyed on digest.
     directories : list of paths to directories to scan
+    jobs, per_device : hashing concurrency, see hash_map()
+    scan_jobs : number of directories listed concurrently
+
+    Files are filtered in stages so that only likely duplicates are read in full:
+     1. group by file size; a file with a unique size cannot have a duplicate
+     2. hash the first and last samplesize bytes of files with the same size
+     3. compute the full sha1 only for files whose size and sample both collide
+    Hardlinks of one file are read once, through the first link, and are always duplicates of each other.
+    In payload mode (see set_digest_mode()) stages 1 and 2 are skipped and every file is hashed.
     """
-    md = sha1sums(directories)
+    with METRICS.phase('enumerate'):
+        stats = scan_files(directories, scan_jobs)
+        paths = list(stats)
+        sizes = {}
+        links = first_links(paths, sizes, stats)
+    METRICS.count('files_scanned', len(paths))
+    files = [path for path in paths if links[path] == path]
+    linked = set(links[path] for path in paths if links[path] != path)
+
+    digests = {}
+    if payload_mode():
+        # copies with different metadata differ in size and samples, so every file is hashed
+        candidates = set(files)
+
+    else:
+        # stage 1: group by size
+        by_size = multidict()
+        for path in files:
+            by_size[sizes[path]] = path
+
+        # stage 2: group same-size files by head/tail sample digest
+        same_size = [path for group in by_size.values() if len(group) > 1 for path in group]
+        sample_func = lambda path: sha1_sample(path, sizes[path], samplesize, stats[path])
+        by_sample = multidict()
+        with METRICS.phase('sample'):
+            for path,sample in hash_map(same_size, sample_func, jobs=jobs, per_device=per_device, stats=stats):
+                by_sample[(sizes[path], sample)] = path
+                # small files are hashed in full by sha1_sample, no need to read them again
+                if sizes[path] <= 2 * samplesize:
+                    digests[path] = sample
+        candidates = set(path for group in by_sample.values() if len(group) > 1 for path in group) | linked
+
+    # stage 3: full digest of the remaining candidates
+    remaining = [path for path in files if path in candidates and path not in digests]
+    with METRICS.phase('hash'):
+        digests.update(hash_map(remaining, lambda path: sha1(path, st=stats[path]), jobs=jobs, per_device=per_device, stats=stats))
+
+    # build multidict in scan order so the first occurrence is kept first
+    md = multidict()
+    for path in paths:
+        if links[path] in candidates:
+            md[digests[links[path]]] = path
+
     # prune multidict, only keep files that are duplicates
     # use list() to iterate first so dict doesnt change size while pop()ing
-    for digest,paths in list(md.iteritems()):
+    for digest,paths in list(md.items()):
         if len(paths) < 2:
             md.pop(digest)
     
     return md
 
 
-def find_duplicates_with_source(directories, source):
+def find_duplicates_with_source(directories, source, jobs=1, per_device=None, scan_jobs=1):
     """
     similar to find_duplicates but consider something a duplicate if the digest is also in "source"
     directories : list of paths to directories to scan
-    source : a dictionary keyed on sha1 digest or a list of digests
+    source : a Manifest, a dictionary keyed on sha1 digest, or a set or list of digests
+    jobs, per_device : hashing concurrency, see hash_map()
+    scan_jobs : number of directories listed concurrently
     """
     # sha1 of all files in listed directories
-    md = sha1sums(directories)
-    # for digests in both dictionaries (using set operations)
-    keys = source.viewkeys() & md.viewkeys()
-    return multidict(filter(lambda x: x[0] in keys, md.iteritems()))
+    md = sha1sums(directories, jobs=jobs, per_device=per_device, scan_jobs=scan_jobs)
+    return in_source(md, source)
+
+
+def find_duplicates_with_stream(directories, lines, jobs=1, per_device=None, index_path=None, scan_jobs=1):
+    """
+    similar to find_duplicates_with_source but read the source digests from lines of sha1sum output, e.g. stdin,
+    while the directories are hashed, so a slow remote scan and the local scan overlap instead of running one after the other
+    lines : iterable of bytes lines, consumed as they arrive
+    index_path : also save the source digests to this manifest index, see Manifest.save()
+    """
+    with ThreadPoolExecutor(1) as executor:
+        local = executor.submit(sha1sums, directories, jobs=jobs, per_device=per_device, scan_jobs=scan_jobs)
+        # overlaps the enumerate and hash phases of the local scan
+        with METRICS.phase('manifest'):
+            source = Manifest.read(lines)
+        md = local.result()
+    if index_path:
+        with METRICS.phase('manifest_index'):
+            source.save(index_path)
+    return in_source(md, source)
+
+
+def find_similar(directories, distance=SIMILAR_DISTANCE, jobs=1, per_device=None, scan_jobs=1, cache=None):
+    """
+    scan each dir in directories for photos that look alike, e.g. resized, re-exported or re-tagged copies,
+    and return a multidict of groups in scan order, keyed on the hex perceptual hash of the first photo of each group.
+    Photos (PHOTO_FILE_EXTENSIONS) are hashed with similar.dhash(), which needs PIL; hardlinks of one file are hashed once.
+    distance : maximum number of differing hash bits between neighbours of a group, see similar_groups()
+    jobs, per_device, scan_jobs : concurrency, see find_duplicates()
+    cache : ImageHashCache
+    """
+    with METRICS.phase('enumerate'):
+        stats = scan_files(directories, scan_jobs)
+        paths = [path for path in stats if file_format(path) == 'PHOTO']
+        links = first_links(paths, stats=stats)
+    METRICS.count('files_scanned', len(stats))
+    func = lambda path: image_hash(path, stats[path], cache)
+    with METRICS.phase('image_hash'):
+        hashes = dict(hash_map([path for path in paths if links[path] == path], func, jobs=jobs, per_device=per_device, stats=stats))
+    with METRICS.phase('group'):
+        groups = similar_groups([(path, hashes[links[path]]) for path in paths], distance)
+
+    md = multidict()
+    for group in groups:
+        key = '{0:0{1}x}'.format(hashes[links[group[0]]], HASH_SIZE * HASH_SIZE // 4)
+        for path in group:
+            md[key] = path
+    return md
+
+
+def in_source(md, source):
+    """keep the digests of multidict md which are also in source"""
+    return multidict((digest, paths) for digest,paths in md.items() if digest in source)
 
 
 
 def print_duplicates(md):
     """
     print all paths grouped by sha1 digest with blank line between groups.
+    paths which are hardlinks of an earlier path in the group are marked (hardlink).
     """
-    for digest,paths in md.iteritems():
+    for digest,paths in md.items():
+        links = first_links(paths)
         for p in paths:
-            print(digest, p)
+            if links[p] != p:
+                print(digest, p, '(hardlink)')
+            else:
+                print(digest, p)
         # print blank line between groups
         print("")
 
@@ -73,7 +233,7 @@ def delete_duplicates(md, keep_first=True):
     if keep_first==True, then preserve the first path in the list (do not delete).
     Warning: if keep_first==False, then ALL FILES WILL BE DELETED.
     """
-    for digest,paths in md.iteritems():
+    for digest,paths in md.items():
         # do not delete the first path on the list
         keep_path = paths[0]
         # use sets to avoid deleting all files if paths occur multiple times in list
@@ -91,6 +251,63 @@ def delete_duplicates(md, keep_first=True):
         print("")
 
 
+def hardlink_duplicates(md):
+    """
+    replace all but the first path of each digest in md with a hardlink to the first path.
+    Each path is replaced atomically by creating a temporary link next to it and renaming it over the path,
+    so no path is ever missing. Replaced paths take the owner, mode and times of the first path.
+    Paths already linked to the first path, or on another filesystem, are left alone.
+    """
+    for digest,paths in md.items():
+        keep_path = paths[0]
+        keep = os.stat(keep_path)
+        print("+ {d} {p}".format(d=digest, p=keep_path))
+        for p in paths[1:]:
+            tmp = os.path.join(os.path.dirname(p), '.{0}.{1}.photorg-link'.format(os.path.basename(p), os.getpid()))
+            try:
+                st = os.stat(p)
+                if (st.st_dev, st.st_ino) == (keep.st_dev, keep.st_ino):
+                    print("= {d} {p} (already linked)".format(d=digest, p=p))
+                    continue
+                if st.st_dev != keep.st_dev:
+                    print("Error: can not hardlink across filesystems: {0}".format(p))
+                    continue
+                print("= {d} {p}".format(d=digest, p=p))
+                os.link(keep_path, tmp)
+                os.rename(tmp, p)
+            except OSError as e:
+                print("Error:" + str(e))
+                if os.path.lexists(tmp):
+                    os.unlink(tmp)
+
+        print("")
+
+
+def move_duplicates(md, directory, keep_first=True):
+    """
+    move duplicates into directory, keeping their full path below it, e.g. /photos/a.jpg to directory/photos/a.jpg
+    if keep_first==True, then leave the first path in the list in place.
+    Files are moved with a hardlink where possible, otherwise copied; see copy_file().
+    As with delete_duplicates(), directories left empty are kept.
+    """
+    for digest,paths in md.items():
+        keep_path = paths[0]
+        move_paths = paths
+        if keep_first:
+            move_paths = paths[1:]
+            print("+ {d} {p}".format(d=digest, p=keep_path))
+        for p in move_paths:
+            target = os.path.join(directory, os.path.relpath(p, '/'))
+            try:
+                print("> {d} {p} {t}".format(d=digest, p=p, t=target))
+                copy_file(p, target, hardlink=True, delete=True, keep_dir=os.path.dirname(p))
+            # copy_file() raises a plain Exception if p has vanished since it was hashed
+            except Exception as e:
+                print("Error:" + str(e).strip())
+
+        print("")
+
+
 
 def deduplicate_main():
     """
@@ -110,25 +327,123 @@ def deduplicate_main():
         ssh user@myserver find ~/photos -type f -exec 'sha1sum {} \;' > server_photo_sha1sums.txt
         photorg-deduplicate --from-file server_photo_sha1sums.txt ~/local_photos --delete
 
+    Or stream the server digests while the local files are hashed, without a temporary file:
+
+        ssh user@myserver find ~/photos -type f -exec 'sha1sum {} +' | photorg-deduplicate --from-stdin ~/local_photos
+
+    To compare repeatedly against the same server snapshot, keep a memory-mapped index of it:
+
+        photorg-deduplicate --from-file server_photo_sha1sums.txt --manifest-index server.idx ~/local_photos
+        photorg-deduplicate --manifest-index server.idx ~/other_photos
+
+    To list photos that look alike although their bytes differ (resized, re-exported, metadata rewritten), with Pillow installed:
+
+        photorg-deduplicate --similar --jobs 4 --cache ~/photos
+
+    To also find copies whose metadata was edited, e.g. retagged by a photo manager, compare only image and video data:
+
+        photorg-deduplicate --payload ~/photos
+
+    With --payload, --delete keeps only the first occurance and also deletes copies whose metadata differs from it,
+    e.g. the retagged copies; move them aside with --move to review them first. --hardlink is refused, as the links
+    would replace the retagged copies with the metadata of the first occurance.
+
+    To reuse digests across runs, and later drop cache entries for files that no longer exist:
+
+        photorg-deduplicate --cache ~/photos
+        photorg-deduplicate --cache --cache-evict --cache-compact
+
     """
 
-    parser = argparse.ArgumentParser(description=__doc__.strip())
-    parser.add_argument('directories', metavar='DIR', nargs='+', help='Directories to scan for duplicates')
+    parser = argparse.ArgumentParser(description=deduplicate_main.__doc__.strip(), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directories', metavar='DIR', nargs='*', help='Directories to scan for duplicates')
     parser.add_argument('--delete', action='store_true', help='delete ALL except first occurance of duplicate files')
     #parser.add_argument('--delete-all', action='store_true', help='delete ALL including first occurance')
-    #parser.add_argument('--hardlink', action='store_true', help='Replace duplicate with hardlink')
-    #parser.add_argument('--move',  help='Move duplicates to specified directory')
+    parser.add_argument('--hardlink', action='store_true', help='Replace duplicates with a hardlink to the first occurance')
+    parser.add_argument('--move', metavar='DIR', help='Move duplicates into DIR, keeping their full path below it')
+    parser.add_argument('--similar', action='store_true', help='List groups of photos that look alike by perceptual hash instead of identical files; needs Pillow')
+    parser.add_argument('--distance', type=int, default=SIMILAR_DISTANCE, help='With --similar, maximum number of the {0} hash bits that may differ between similar photos (default {1})'.format(HASH_SIZE * HASH_SIZE, SIMILAR_DISTANCE))
+    parser.add_argument('--payload', action='store_true', help='Compare only the image and video data of files, so copies whose metadata was edited are duplicates (JPEG, PNG, MP4/MOV; other files are compared in full). With --delete, such retagged copies are deleted too; not with --hardlink')
     parser.add_argument('--from-file',  help='Provide a text file with sha1sums from an alternate location')
-    parser.add_argument('--from-stdin',  help='Provide a text file with sha1sums from an alternate location')
+    parser.add_argument('--manifest-index', metavar='FILE', help='Memory-mapped index of the --from-file digests; written if missing or older than --from-file, otherwise used instead of reading it. With --from-stdin, always written')
+    parser.add_argument('--from-stdin', action='store_true', help='Read sha1sums from an alternate location on stdin as they arrive, while hashing the directories')
     #parser.add_argument('--protect', action='store_true', help='Do not delete ANY file from first directory, even if duplicates exist')
-    #parser.add_argument('--cache', action='store_true', help='Cache resulting SHA1 digests and use for subsequent invocations')
+    parser.add_argument('--cache', action='store_true', help='Cache resulting SHA1 digests and use for subsequent invocations')
+    parser.add_argument('--cache-file', default=default_cache_path(), help='Location of the digest cache (default {0})'.format(default_cache_path()))
+    parser.add_argument('--image-cache-file', default=default_cache_path('imagehashes.sqlite'), help='With --similar and --cache, location of the perceptual hash cache (default {0})'.format(default_cache_path('imagehashes.sqlite')))
+    parser.add_argument('--cache-evict', action='store_true', help='Remove cache entries for files that no longer exist')
+    parser.add_argument('--cache-compact', action='store_true', help='Reclaim unused space in the cache file')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of files to hash concurrently (default 1)')
+    parser.add_argument('--scan-jobs', type=int, default=1, help='Number of directories listed concurrently, e.g. 8 to hide the latency of network filesystems (default 1)')
+    parser.add_argument('--jobs-per-device', type=int, help='Maximum concurrent reads per device; e.g. 1 for spinning disks (default unlimited)')
     parser.add_argument('--verbose', action='store_true', help='display verbose messages')
+    parser.add_argument('--stats-file', metavar='FILE', help='At exit, write phase timings, bytes read and the slowest files to FILE as JSON, or in the Prometheus text format if FILE ends in .prom')
     args = parser.parse_args()
 
+    if len([a for a in (args.delete, args.hardlink, args.move) if a]) > 1:
+        parser.error('only one of --delete, --hardlink and --move can be used')
+    if args.hardlink and (args.from_file or args.from_stdin or args.manifest_index):
+        parser.error('--hardlink needs a local first occurance; use --delete or --move with --from-file or --from-stdin')
+    if args.similar and (args.delete or args.hardlink or args.move or args.from_file or args.from_stdin or args.manifest_index):
+        parser.error('--similar only lists groups of similar photos; review them before removing any')
+    if args.from_stdin and args.from_file:
+        parser.error('use only one of --from-file and --from-stdin')
+    if args.manifest_index and not (args.from_file or args.from_stdin or os.path.exists(args.manifest_index)):
+        parser.error('--manifest-index {0} does not exist; create it with --from-file or --from-stdin'.format(args.manifest_index))
+    if args.payload and (args.from_file or args.from_stdin or args.manifest_index or args.similar):
+        parser.error('--payload digests can not be compared with sha1sum manifests or perceptual hashes')
+    if args.payload and args.hardlink:
+        parser.error('--payload duplicates may differ in metadata, which --hardlink would discard; use --move to review them')
+    if (args.cache_evict or args.cache_compact) and not args.cache:
+        parser.error('--cache-evict and --cache-compact maintain the digest cache; use them with --cache')
+    if not 0 <= args.distance <= HASH_SIZE * HASH_SIZE:
+        parser.error('--distance must be between 0 and {0}'.format(HASH_SIZE * HASH_SIZE))
+    if args.similar and similar.Image is None:
+        parser.error('--similar needs the Pillow package, e.g. pip install photorg[similar]')
+
     # set verbose flag
     global VERBOSE
     VERBOSE = args.verbose
 
+    cache = None
+    if args.cache:
+        cache = DigestCache(args.cache_file)
+        set_digest_cache(cache)
+
+        if args.cache_evict:
+            print("Evicted {0} stale cache entries".format(cache.evict()))
+
+        if args.cache_compact:
+            cache.compact()
+
+    METRICS.tool = 'deduplicate'
+    status = 'error'
+    if args.payload:
+        set_digest_mode('payload')
+
+    image_cache = None
+    if args.cache and args.similar:
+        image_cache = ImageHashCache(args.image_cache_file)
+
+    try:
+        run_deduplicate(parser, args, image_cache)
+        status = 'ok'
+    finally:
+        if cache is not None:
+            set_digest_cache(None)
+            cache.close()
+        set_digest_mode('file')
+        if image_cache is not None:
+            image_cache.close()
+        if args.stats_file:
+            write_stats(args.stats_file, status, cache, image_cache)
+
+
+def run_deduplicate(parser, args, image_cache=None):
+    """
+    run the deduplicate command for parsed args
+    image_cache : ImageHashCache for --similar
+    """
     if args.directories:
 
         # first verify that the directories are valid
@@ -138,42 +453,74 @@ def deduplicate_main():
                 sys.exit(1)
 
  
-        # --from-file
-        if args.from_file:
-            # parse source file into multidict
-            source_md = multidict()
-            with open(args.from_file) as f:
-                for line in f:
-                    # maxsplit=1 in case there are spaces in the path
-                    digest,path = line.split(' ', 1)
-                    source_md[digest] = path.strip()
-                
-            # find files that are duplicates of those listed in source file
-            md = find_duplicates_with_source(args.directories, source_md)
-
-            # --delete 
-            if args.delete:
-                # detele all including the first because assumed that source files are stored elsewhere
-                delete_duplicates(md, keep_first=False)
-            
-            # default
-            else:
+        # --similar
+        if args.similar:
+            md = find_similar(args.directories, distance=args.distance, jobs=args.jobs, per_device=args.jobs_per_device, scan_jobs=args.scan_jobs, cache=image_cache)
+            METRICS.count('similar_groups', len(md))
+            with METRICS.phase('act'):
                 print_duplicates(md)
 
+        # --from-file, --from-stdin
+        elif args.from_file or args.from_stdin or args.manifest_index:
+            # find files that are duplicates of those listed on stdin, hashing local files meanwhile
+            if args.from_stdin:
+                md = find_duplicates_with_stream(args.directories, sys.stdin.buffer, jobs=args.jobs, per_device=args.jobs_per_device, index_path=args.manifest_index, scan_jobs=args.scan_jobs)
+
+            # find files that are duplicates of those listed in source file, or its index
+            else:
+                with METRICS.phase('manifest'):
+                    try:
+                        source = open_manifest(args.from_file, args.manifest_index)
+                    except ValueError as e:
+                        sys.stderr.write('{0}\n'.format(e))
+                        sys.exit(1)
+                try:
+                    md = find_duplicates_with_source(args.directories, source, jobs=args.jobs, per_device=args.jobs_per_device, scan_jobs=args.scan_jobs)
+                finally:
+                    source.close()
+
+            METRICS.count('duplicate_groups', len(md))
+            METRICS.count('duplicates', sum(len(paths) for paths in md.values()))
+            with METRICS.phase('act'):
+                # --delete 
+                if args.delete:
+                    # detele all including the first because assumed that source files are stored elsewhere
+                    delete_duplicates(md, keep_first=False)
+
+                # --move
+                elif args.move:
+                    move_duplicates(md, args.move, keep_first=False)
+                
+                # default
+                else:
+                    print_duplicates(md)
+
         # find duplicates in local directories
         else:
-            md = find_duplicates(args.directories)
+            md = find_duplicates(args.directories, jobs=args.jobs, per_device=args.jobs_per_device, scan_jobs=args.scan_jobs)
+            METRICS.count('duplicate_groups', len(md))
+            METRICS.count('duplicates', sum(len(paths) - 1 for paths in md.values()))
 
-            # --delete 
-            if args.delete:
-                delete_duplicates(md)
+            with METRICS.phase('act'):
+                # --delete 
+                if args.delete:
+                    delete_duplicates(md)
 
-            # default
-            else:
-                print_duplicates(md)
+                # --hardlink
+                elif args.hardlink:
+                    hardlink_duplicates(md)
+
+                # --move
+                elif args.move:
+                    move_duplicates(md, args.move)
+
+                # default
+                else:
+                    print_duplicates(md)
 
     # argument error, print usage
-    else:
+    # (cache maintenance without directories is a complete command)
+    elif not (args.cache_evict or args.cache_compact):
         parser.print_usage()
 
 
@@ -0,0 +1,200 @@
+"""
+persistent index of the event directories in DEST
+"""
+
+import os
+import json
+import logging
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+from .plan import DATE_FORMAT
+
+logger = logging.getLogger('photorg')
+
+EVENT_INDEX_NAME = '.photorg-events'
+
+
+class EventIndex(object):
+    """
+    date ranges (start, end) of the event directories in dest, sorted by start for bisect lookups.
+    The index is stored as JSON lines in dest/.photorg-events: a header, then one record per event.
+    Changed events are appended by flush(), the last record of an event wins,
+    and the file is rewritten on load() once superseded records outnumber the events.
+    Events added by a run start at the exact time of their first file, and are stored with exact times.
+    Events found by scan() only have the day precision of their directory names, so they span the whole day.
+    """
+
+    def __init__(self, dest, date_fmt="%Y/%Y-%m-%d"):
+        self.dest = dest
+        self.date_fmt = date_fmt
+        self.starts = []
+        self.ends = []
+        self.dirs = []
+        # event_dir -> start, to locate events without a linear search
+        self.by_dir = {}
+        self.path = None
+        self.dirty = set()
+
+    @classmethod
+    def scan(cls, dest, date_fmt="%Y/%Y-%m-%d"):
+        """index the existing event directories in dest, named by new_event_dir()"""
+        index = cls(dest, date_fmt)
+        name_fmt = date_fmt.split('/')[-1]
+        depth = date_fmt.count('/')
+        for root, dirs, files in os.walk(dest):
+            rel = os.path.relpath(root, dest)
+            if rel.count('/') >= depth:
+                dirs[:] = []
+            try:
+                date = datetime.strptime(os.path.basename(root), name_fmt)
+            except ValueError:
+                continue
+            if date.strftime(date_fmt) == rel:
+                index.insert(date, day_end(date), root)
+        return index
+
+    @classmethod
+    def load(cls, dest, date_fmt="%Y/%Y-%m-%d", rescan=False, simulate=False):
+        """
+        read the index stored in dest, or scan dest if there is none (or rescan).
+        Events whose directory no longer exists are dropped. Changes are saved by flush() and close().
+        simulate : never write the index file, not even a rebuilt one
+        """
+        path = os.path.join(dest, EVENT_INDEX_NAME)
+        index = None
+        records = 0
+        if os.path.exists(path) and not rescan:
+            index = cls(dest, date_fmt)
+            events = {}
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning("Ignoring partial event index record: {0}".format(line.strip()))
+                        continue
+                    if 'events' in record:
+                        if record.get('date_fmt') != date_fmt:
+                            index = None
+                            break
+                        continue
+                    records += 1
+                    events[record['dir']] = record
+            if index is not None:
+                for rel,record in events.items():
+                    event_dir = os.path.join(dest, rel)
+                    if os.path.isdir(event_dir):
+                        index.insert(datetime.strptime(record['start'], DATE_FORMAT), datetime.strptime(record['end'], DATE_FORMAT), event_dir)
+                    else:
+                        records += 1
+
+        if index is None:
+            logger.info("Indexing events in {0}".format(dest))
+            index = cls.scan(dest, date_fmt)
+            records = None
+
+        if simulate:
+            logger.info("{0} existing events in {1}".format(len(index), dest))
+            return index
+        index.path = path
+        if records is None or records > 2 * len(index):
+            index.save()
+        logger.info("{0} existing events in {1}".format(len(index), dest))
+        return index
+
+    def save(self):
+        """rewrite the index file with one record per event"""
+        if not os.path.isdir(self.dest):
+            os.makedirs(self.dest, 0o755)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'events': 1, 'date_fmt': self.date_fmt}) + '\n')
+            for i in range(len(self)):
+                f.write(json.dumps(self.record(i)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.dirty = set()
+
+    def record(self, i):
+        return {'dir': os.path.relpath(self.dirs[i], self.dest), 'start': self.starts[i].strftime(DATE_FORMAT), 'end': self.ends[i].strftime(DATE_FORMAT)}
+
+    def flush(self):
+        """append records of the events changed since the last flush"""
+        if not self.path or not self.dirty:
+            return
+        with open(self.path, 'a') as f:
+            for i in range(len(self)):
+                if self.dirs[i] in self.dirty:
+                    f.write(json.dumps(self.record(i)) + '\n')
+        self.dirty = set()
+
+    def close(self):
+        self.flush()
+
+    def find(self, date, day_delta):
+        """
+        return the directory of the latest event starting before date
+        which contains date or started at most day_delta days before it, or None
+        """
+        i = bisect_right(self.starts, date) - 1
+        if i >= 0 and (date <= self.ends[i] or (date - self.starts[i]).days <= day_delta):
+            return self.dirs[i]
+        return None
+
+    def limit(self, event_dir, day_delta):
+        """
+        return the date before which find() assigns every file dated after the start of event_dir to it:
+        the later of the end of its range and day_delta days after its start, but not after the next event starts
+        """
+        i = self.position(event_dir)
+        try:
+            limit = max(self.ends[i] + timedelta(microseconds=1), self.starts[i] + timedelta(days=day_delta + 1))
+        except OverflowError:
+            limit = datetime.max
+        if i + 1 < len(self):
+            limit = min(limit, self.starts[i + 1])
+        return limit
+
+    def insert(self, start, end, event_dir):
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.dirs.insert(i, event_dir)
+        self.by_dir[event_dir] = start
+
+    def position(self, event_dir):
+        i = bisect_left(self.starts, self.by_dir[event_dir])
+        while self.dirs[i] != event_dir:
+            i += 1
+        return i
+
+    def add(self, date, event_dir):
+        """record a file dated date in event_dir, extending its event or adding a new one"""
+        if event_dir not in self.by_dir:
+            self.insert(date, date, event_dir)
+            self.dirty.add(event_dir)
+            return
+        i = self.position(event_dir)
+        if date > self.ends[i]:
+            self.ends[i] = date
+            self.dirty.add(event_dir)
+        if date < self.starts[i]:
+            # keep starts sorted
+            end = self.ends[i]
+            del self.starts[i], self.ends[i], self.dirs[i]
+            self.insert(date, end, event_dir)
+            self.dirty.add(event_dir)
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def day_end(date):
+    return date.replace(hour=23, minute=59, second=59, microsecond=999999)
+
+
+def is_event_index(path):
+    """check if path is an event index file (or its temporary file while saved), which is not a photo of the event tree"""
+    return os.path.basename(path).startswith(EVENT_INDEX_NAME)
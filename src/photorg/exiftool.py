@@ -0,0 +1,192 @@
+"""
+persistent exiftool workers (exiftool -stay_open True -@ -)
+"""
+
+import os
+import json
+import queue
+import logging
+import selectors
+import time
+from subprocess import Popen, PIPE
+
+from .common import hash_map, batches
+from .metrics import METRICS
+
+logger = logging.getLogger('photorg')
+
+
+EXIFTOOL = '/usr/bin/exiftool'
+EXIFTOOL_BATCH_SIZE = 200
+EXIFTOOL_ARGS = ['-json', '-dateFormat', '%Y-%m-%d %H:%M:%S']
+
+
+class ExiftoolError(Exception):
+    pass
+
+
+class ExiftoolWorker(object):
+    """
+    a long-lived exiftool process reading arguments from stdin.
+    The process is started on first use and restarted by the next execute() after close().
+    """
+
+    def __init__(self, executable=None, timeout=None):
+        self.executable = executable or EXIFTOOL
+        self.timeout = timeout
+        self.process = None
+        self.count = 0
+
+    def start(self):
+        logger.debug('Starting exiftool worker')
+        self.process = Popen([self.executable, '-stay_open', 'True', '-@', '-'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        METRICS.count('subprocesses')
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, args):
+        """run one exiftool command with args and return (stdout, stderr) bytes"""
+        if not self.running():
+            self.start()
+
+        # each argument is one line of the argfile
+        for arg in args:
+            if '\n' in arg:
+                raise ExiftoolError('exiftool arguments can not contain newlines: {0!r}'.format(arg))
+
+        # -echo4 writes the sentinel to stderr after the command completes; -executeN writes {readyN} to stdout
+        self.count += 1
+        ready = '{{ready{0}}}'.format(self.count)
+        lines = list(args) + ['-echo4', ready, '-execute{0}'.format(self.count)]
+        start = time.monotonic()
+        try:
+            self.process.stdin.write(b''.join(os.fsencode(line) + b'\n' for line in lines))
+            self.process.stdin.flush()
+        except OSError as e:
+            self.close()
+            raise ExiftoolError('exiftool exited unexpectedly: {0}'.format(e))
+        out = self.read_until(ready.encode())
+        METRICS.observe('exiftool', time.monotonic() - start)
+        return out
+
+    def read_until(self, sentinel):
+        """read stdout and stderr concurrently until both end with sentinel"""
+        streams = {self.process.stdout.fileno(): bytearray(), self.process.stderr.fileno(): bytearray()}
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        with selectors.DefaultSelector() as selector:
+            for fd in streams:
+                selector.register(fd, selectors.EVENT_READ)
+            while selector.get_map():
+                timeout = max(0, deadline - time.monotonic()) if deadline else None
+                events = selector.select(timeout)
+                if not events:
+                    self.close()
+                    raise ExiftoolError('exiftool timed out after {0} seconds'.format(self.timeout))
+                for key,mask in events:
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        self.close()
+                        raise ExiftoolError('exiftool exited unexpectedly')
+                    buf = streams[key.fd]
+                    buf.extend(data)
+                    if buf[-64:].rstrip().endswith(sentinel):
+                        selector.unregister(key.fd)
+                        del buf[buf.rfind(sentinel):]
+
+        return bytes(streams[self.process.stdout.fileno()]), bytes(streams[self.process.stderr.fileno()])
+
+    def close(self):
+        if self.process is None:
+            return
+        if self.running():
+            try:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.wait(5)
+            except Exception:
+                self.process.kill()
+                self.process.wait()
+        for f in (self.process.stdin, self.process.stdout, self.process.stderr):
+            f.close()
+        self.process = None
+
+
+class ExiftoolPool(object):
+    """
+    a pool of exiftool workers which are fed files in batches.
+    Batches run concurrently on up to workers processes and results are returned in input order.
+    A worker that crashes or times out is restarted and the batch is retried; a batch which still fails is split in halves
+    and each half retried, so one bad file only loses itself rather than the whole batch.
+    The pool may be reused for many calls; close() stops the workers.
+    """
+
+    def __init__(self, workers=1, batch_size=EXIFTOOL_BATCH_SIZE, executable=None, timeout=None, retries=1):
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.all = [ExiftoolWorker(executable, timeout) for i in range(self.workers)]
+        self.idle = queue.Queue()
+        for worker in self.all:
+            self.idle.put(worker)
+
+    def execute(self, args):
+        """run args on an idle worker, retrying on a fresh process if it fails, return stdout bytes; raises ExiftoolError"""
+        worker = self.idle.get()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    out,err = worker.execute(args)
+                    break
+                except ExiftoolError as e:
+                    logger.warning("{0}; restarting worker".format(str(e)))
+            else:
+                raise ExiftoolError("exiftool failed {0} times".format(self.retries + 1))
+        finally:
+            self.idle.put(worker)
+
+        if err.strip():
+            for msg in err.decode(errors='replace').strip().split('\n'):
+                logger.warning("exiftool: " + msg.strip())
+        return out
+
+    def json(self, paths, args=EXIFTOOL_ARGS):
+        """run exiftool on a batch of paths and return the parsed json list"""
+        for path in [p for p in paths if '\n' in p]:
+            logger.error("Can not pass path with newline to exiftool: {0!r}".format(path))
+        paths = [p for p in paths if '\n' not in p]
+        if not paths:
+            return []
+        try:
+            out = self.execute(list(args) + paths)
+        except ExiftoolError as e:
+            if len(paths) == 1:
+                logger.error("{0}; skipping {1}".format(str(e), paths[0]))
+                return []
+            logger.warning("{0}; splitting batch of {1} files".format(str(e), len(paths)))
+            half = len(paths) // 2
+            return self.json(paths[:half], args) + self.json(paths[half:], args)
+        if not out.strip():
+            return []
+        try:
+            return json.loads(out)
+        except ValueError as e:
+            logger.error("Could not parse exiftool json: {0}".format(str(e)))
+            return []
+
+    def metadata(self, paths, args=EXIFTOOL_ARGS):
+        """yield one exiftool json dict per file in paths, processing batches in parallel"""
+        func = lambda batch: self.json(batch, args)
+        for batch,results in hash_map(batches(paths, self.batch_size), func, jobs=self.workers):
+            for exif in results:
+                yield exif
+
+    def close(self):
+        for worker in self.all:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
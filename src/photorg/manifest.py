@@ -0,0 +1,161 @@
+"""
+compact sets of sha1 digests read from sha1sum manifests, optionally stored as memory-mapped index files
+"""
+
+import os
+import mmap
+import struct
+import logging
+import binascii
+
+logger = logging.getLogger('photorg')
+
+
+DIGEST_SIZE = 20
+
+# index file: header (magic, count), fanout table, then the sorted digests
+INDEX_MAGIC = b'PHOTORG-SHA1IDX1'
+INDEX_HEADER = struct.Struct('<16sQ')
+INDEX_FANOUT = struct.Struct('<257Q')
+
+
+class Manifest(object):
+    """
+    a set of binary sha1 digests, e.g. of the files on a server, for membership tests.
+    Digests are kept sorted and concatenated in one buffer, 20 bytes each, and found by binary search
+    within the range of their first byte (the fanout table), so tens of millions of digests take
+    a fraction of the memory of a dict of hex strings.
+    The buffer may be a memory-mapped index file written by save(); opening it does not read the digests.
+    Digests may be given as hex strings or bytes.
+    """
+
+    def __init__(self, buffer=b'', fanout=None, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+        self.fanout = fanout or [0] * 257
+        self.file = None
+
+    @classmethod
+    def read(cls, lines):
+        """build a Manifest from an iterable of sha1sum output lines (bytes), one line at a time"""
+        # digests are uniformly distributed, so bucketing by first byte leaves 256 small sorts
+        buckets = [bytearray() for i in range(256)]
+        count = 0
+        skipped = 0
+        for line in lines:
+            # sha1sum escapes file names containing a backslash or newline, and marks the line with a leading backslash
+            if line.startswith(b'\\'):
+                line = line[1:]
+            try:
+                if line[40:41] != b' ':
+                    raise ValueError(line)
+                digest = binascii.unhexlify(line[:40])
+            except ValueError:
+                skipped += 1
+                continue
+            buckets[digest[0]] += digest
+            count += 1
+        if skipped:
+            logger.warning("Skipped {0} lines which are not sha1sum output".format(skipped))
+
+        buffer = bytearray()
+        fanout = [0]
+        for i in range(256):
+            bucket = bytes(buckets[i])
+            buckets[i] = None
+            digests = sorted(set(bucket[j:j + DIGEST_SIZE] for j in range(0, len(bucket), DIGEST_SIZE)))
+            buffer += b''.join(digests)
+            fanout.append(fanout[-1] + len(digests))
+        logger.info("Read {0} digests, {1} unique".format(count, fanout[-1]))
+        return cls(buffer, fanout)
+
+    @classmethod
+    def load(cls, path):
+        """read a sha1sum manifest file"""
+        with open(path, 'rb') as f:
+            return cls.read(f)
+
+    @classmethod
+    def open(cls, path):
+        """memory-map an index file written by save(); raises ValueError if path is not one, e.g. empty or truncated"""
+        with open(path, 'rb') as f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # an empty file can not be mapped
+            except ValueError:
+                raise ValueError('{0} is not a manifest index'.format(path))
+        try:
+            magic, count = INDEX_HEADER.unpack_from(buffer, 0)
+            offset = INDEX_HEADER.size + INDEX_FANOUT.size
+            if magic != INDEX_MAGIC or len(buffer) != offset + count * DIGEST_SIZE:
+                raise ValueError('{0} is not a manifest index'.format(path))
+        except (ValueError, struct.error):
+            buffer.close()
+            raise ValueError('{0} is not a manifest index'.format(path))
+        manifest = cls(buffer, list(INDEX_FANOUT.unpack_from(buffer, INDEX_HEADER.size)), offset)
+        manifest.file = buffer
+        logger.info("Opened index of {0} digests: {1}".format(count, path))
+        return manifest
+
+    def save(self, path):
+        """write the digests to an index file which open() can memory-map"""
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(self)))
+            f.write(INDEX_FANOUT.pack(*self.fanout))
+            f.write(self.buffer[self.offset:])
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def __contains__(self, digest):
+        if isinstance(digest, str):
+            try:
+                digest = bytes.fromhex(digest)
+            except ValueError:
+                return False
+        if len(digest) != DIGEST_SIZE:
+            return False
+        lo = self.fanout[digest[0]]
+        hi = self.fanout[digest[0] + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.offset + mid * DIGEST_SIZE
+            record = self.buffer[start:start + DIGEST_SIZE]
+            if record < digest:
+                lo = mid + 1
+            elif record > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        return self.fanout[-1]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def open_manifest(path=None, index_path=None):
+    """
+    return a Manifest of the sha1sum file at path.
+    index_path : index file; it is used instead of reading path if it is at least as new as path (or path is None),
+        otherwise, or if it is not a valid index, it is written from path
+    raises ValueError if path is None and index_path is not a valid index
+    """
+    if index_path and os.path.exists(index_path):
+        if path is None or os.path.getmtime(index_path) >= os.path.getmtime(path):
+            try:
+                return Manifest.open(index_path)
+            except ValueError as e:
+                if path is None:
+                    raise
+                logger.warning("{0}; rebuilding it from {1}".format(e, path))
+    manifest = Manifest.load(path)
+    if index_path:
+        manifest.save(index_path)
+        logger.info("Saved index of {0} digests: {1}".format(len(manifest), index_path))
+    return manifest
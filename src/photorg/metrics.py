@@ -0,0 +1,160 @@
+"""
+run metrics: wall time per phase, counters, subprocess and per-file latencies, and the slowest files,
+reported as JSON or as a Prometheus textfile (e.g. for the node_exporter textfile collector)
+"""
+
+import os
+import json
+import time
+import heapq
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('photorg')
+
+
+# number of slowest files kept in the report
+SLOWEST_FILES = 10
+
+
+class Metrics(object):
+    """
+    metrics of one run, safe to update from worker threads.
+     - phases : seconds spent in each top-level step; phases run one after the other, repeated phases add up
+     - counters : totals such as bytes_read, bytes_written, files_copied, cache hits
+     - timings : count, total and maximum seconds of repeated operations, e.g. each ffprobe process or exiftool batch;
+       these run concurrently and within phases, so they do not add up to the wall time
+     - slowest : the slowest single-file operations, with their path
+    """
+
+    def __init__(self, tool='photorg', slowest=SLOWEST_FILES):
+        self.tool = tool
+        self.slowest_count = slowest
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.timings = {}
+        self.slowest = []
+
+    @contextmanager
+    def phase(self, name):
+        """time the enclosed block as phase name"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds, path=None):
+        """record one operation of seconds; if path is given it is a candidate for the slowest files"""
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            if path is not None:
+                item = (seconds, name, path)
+                if len(self.slowest) < self.slowest_count:
+                    heapq.heappush(self.slowest, item)
+                elif item > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, item)
+
+    @contextmanager
+    def timed(self, name, path=None):
+        """observe the duration of the enclosed block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, path)
+
+    def report(self, status='ok'):
+        """return the metrics as a dict"""
+        with self.lock:
+            return {
+                'tool': self.tool,
+                'status': status,
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'phases': dict(self.phases),
+                'counters': dict(self.counters),
+                'timings': dict((name, {'count': t[0], 'seconds': t[1], 'max_seconds': t[2]}) for name,t in self.timings.items()),
+                'slowest': [{'seconds': s, 'operation': name, 'path': path} for s,name,path in sorted(self.slowest, reverse=True)],
+            }
+
+    def prometheus(self, status='ok'):
+        """
+        return the metrics in the Prometheus text format.
+        All values describe the last run, so they are gauges labelled with the tool; the slowest files are left out
+        since a label per path would make a new series every run.
+        """
+        report = self.report(status)
+        tool = report['tool']
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append('# HELP photorg_{0} {1}'.format(name, help))
+            lines.append('# TYPE photorg_{0} gauge'.format(name))
+            for labels,value in samples:
+                labels = ','.join(['tool="{0}"'.format(tool)] + ['{0}="{1}"'.format(k, escape(v)) for k,v in labels])
+                lines.append('photorg_{0}{{{1}}} {2}'.format(name, labels, value))
+
+        metric('last_run_timestamp_seconds', 'Start time of the last run', [((), report['started'])])
+        metric('last_run_seconds', 'Wall time of the last run', [((), report['seconds'])])
+        metric('last_run_success', 'Whether the last run finished without an unhandled error', [((), int(status == 'ok'))])
+        metric('phase_seconds', 'Wall time per phase of the last run', [((('phase', k),), v) for k,v in sorted(report['phases'].items())])
+        for name,value in sorted(report['counters'].items()):
+            metric(name, 'Total of {0} in the last run'.format(name.replace('_', ' ')), [((), value)])
+        timings = sorted(report['timings'].items())
+        metric('operations', 'Number of timed operations in the last run', [((('operation', k),), t['count']) for k,t in timings])
+        metric('operation_seconds', 'Total seconds of timed operations in the last run', [((('operation', k),), t['seconds']) for k,t in timings])
+        metric('operation_max_seconds', 'Slowest timed operation in the last run', [((('operation', k),), t['max_seconds']) for k,t in timings])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, status='ok'):
+        """
+        write the report to path, in the Prometheus text format if path ends in .prom, otherwise as JSON.
+        The file is replaced atomically, so a collector never reads a partial report.
+        """
+        if path.endswith('.prom'):
+            data = self.prometheus(status)
+        else:
+            data = json.dumps(self.report(status), indent=1) + '\n'
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+        logger.info("Wrote run statistics to {0}".format(path))
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# metrics of this process, updated by all tools
+METRICS = Metrics()
+
+
+def write_stats(path, status='ok', *caches):
+    """write METRICS to path with the hits and misses of caches (None for disabled ones), logging rather than raising errors"""
+    for c in caches:
+        if c is not None:
+            METRICS.count('{0}_cache_hits'.format(c.name), c.hits)
+            METRICS.count('{0}_cache_misses'.format(c.name), c.misses)
+    try:
+        METRICS.write(path, status)
+    except OSError as e:
+        logger.error("Could not write statistics to {0}: {1}".format(path, e))
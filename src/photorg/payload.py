@@ -0,0 +1,184 @@
+"""
+payload digests: sha1 of the image or video data of a file, leaving out metadata,
+so a photo whose EXIF was edited by a photo manager still matches the original
+"""
+
+import os
+import time
+import struct
+import hashlib
+import logging
+import threading
+
+from .metrics import METRICS
+
+logger = logging.getLogger('photorg')
+
+
+PAYLOAD_BLOCK_SIZE = 1 << 16
+
+# JPEG markers without a length field: TEM, RST0-7, SOI, EOI
+JPEG_STANDALONE = set([0x01] + list(range(0xd0, 0xda)))
+
+# JPEG segments left out: APP0-APP15 (JFIF, EXIF, XMP, ICC, Photoshop IRB, MPF, ...) and COM
+JPEG_METADATA = set(list(range(0xe0, 0xf0)) + [0xfe])
+
+# PNG chunks left out: text, EXIF and modification time
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_METADATA = set([b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME'])
+
+# first box types of ISO base media files (MP4, MOV, 3GP, HEIC, ...)
+BMFF_BOXES = set([b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot'])
+
+_buffers = threading.local()
+
+
+class PayloadError(Exception):
+    pass
+
+
+def update(sha, f, count=None):
+    """hash count bytes of f, or the rest of f if count is None"""
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None:
+        buf = _buffers.buf = memoryview(bytearray(PAYLOAD_BLOCK_SIZE))
+    while count is None or count > 0:
+        n = f.readinto(buf if count is None or count >= len(buf) else buf[:count])
+        if not n:
+            if count:
+                raise PayloadError('truncated')
+            return
+        sha.update(buf[:n])
+        if count is not None:
+            count -= n
+
+
+def jpeg_payload(sha, f):
+    """hash every segment except APPn and COM, then the entropy-coded data and anything after it"""
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            raise PayloadError('bad marker')
+        # markers may be preceded by fill bytes
+        while marker[1] == 0xff:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                raise PayloadError('bad marker')
+        if marker[1] in JPEG_STANDALONE:
+            sha.update(marker)
+            if marker[1] == 0xd9:
+                update(sha, f)
+                return
+            continue
+        header = f.read(2)
+        if len(header) < 2:
+            raise PayloadError('truncated')
+        length = struct.unpack('>H', header)[0]
+        if length < 2:
+            raise PayloadError('bad segment length')
+        if marker[1] in JPEG_METADATA:
+            f.seek(length - 2, os.SEEK_CUR)
+            continue
+        sha.update(marker + header)
+        update(sha, f, length - 2)
+        # SOS: scan data follows, with any further tables and scans of a progressive JPEG
+        if marker[1] == 0xda:
+            update(sha, f)
+            return
+
+
+def png_payload(sha, f):
+    """hash the signature and every chunk except text, EXIF and tIME"""
+    sha.update(f.read(len(PNG_SIGNATURE)))
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise PayloadError('truncated')
+        length, kind = struct.unpack('>I4s', header)
+        if kind in PNG_METADATA:
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+        sha.update(header)
+        # data and crc
+        update(sha, f, length + 4)
+        if kind == b'IEND':
+            return
+
+
+def bmff_payload(sha, f, size):
+    """
+    hash the media data (mdat boxes) of an ISO base media file.
+    moov is left out as a whole rather than just its udta and meta boxes: its chunk offset tables point into mdat,
+    so they change whenever metadata stored before mdat grows or shrinks.
+    """
+    found = False
+    pos = 0
+    while pos + 8 <= size:
+        f.seek(pos)
+        header = f.read(16)
+        box_size, kind = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if box_size == 1:
+            if len(header) < 16:
+                raise PayloadError('truncated')
+            box_size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif box_size == 0:
+            # last box, extends to the end of the file
+            box_size = size - pos
+        if box_size < header_size or pos + box_size > size:
+            raise PayloadError('bad box size')
+        if kind == b'mdat':
+            f.seek(pos + header_size)
+            update(sha, f, box_size - header_size)
+            found = True
+        pos += box_size
+    if not found:
+        raise PayloadError('no media data')
+
+
+def payload_format(head):
+    """return the payload format of a file starting with head, or None"""
+    if head[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if head[:8] == PNG_SIGNATURE:
+        return 'png'
+    if head[4:8] in BMFF_BOXES:
+        return 'bmff'
+    return None
+
+
+def payload_sha1(path):
+    """
+    return the sha1 hex digest of the image or video data of path, leaving out metadata:
+     - JPEG : APPn segments (JFIF, EXIF, XMP, ICC, MPF, ...) and comments
+     - PNG : tEXt, zTXt, iTXt, eXIf and tIME chunks
+     - MP4, MOV and other ISO base media files : everything but the mdat boxes, including udta and meta
+    Files in other formats, or which can not be parsed, are hashed in full, like sha1_file().
+    The digest is only comparable to other payload digests.
+    """
+    start = time.monotonic()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        format = payload_format(f.read(16))
+        sha = hashlib.sha1()
+        try:
+            f.seek(0)
+            if format == 'jpeg':
+                f.seek(2)
+                sha.update(b'\xff\xd8')
+                jpeg_payload(sha, f)
+            elif format == 'png':
+                png_payload(sha, f)
+            elif format == 'bmff':
+                bmff_payload(sha, f, size)
+            else:
+                update(sha, f)
+        except (PayloadError, struct.error) as e:
+            logger.debug("Hashing all of {0}, can not parse it as {1}: {2}".format(path, format, e))
+            f.seek(0)
+            sha = hashlib.sha1()
+            update(sha, f)
+    METRICS.observe('payload_sha1', time.monotonic() - start, path)
+    METRICS.count('bytes_read', size)
+    return sha.hexdigest()
@@ -3,15 +3,28 @@
 from __future__ import absolute_import
 import logging.handlers
 import os
-import sys
 import json
 import logging 
 import argparse
+import threading
 
-from datetime import datetime
-from multiprocessing import Pool, cpu_count
-from subprocess import Popen, PIPE
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from subprocess import Popen, PIPE, TimeoutExpired
 from .common import *
+from .cache import DigestCache, MetadataCache, default_cache_path
+from .exiftool import ExiftoolPool, EXIFTOOL_ARGS, EXIFTOOL_BATCH_SIZE
+from .plan import TransferPlan
+from .events import EventIndex, EVENT_INDEX_NAME, is_event_index
+from .watch import make_watcher
+from .metrics import METRICS, write_stats
+
+# optional, parses and sorts dates in bulk for large libraries
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 logger = logging.getLogger('photorg')
 
@@ -29,6 +42,20 @@ IMAGE_FILE_EXTENSIONS = ['jpg', 'jpeg', 'jxl', 'png', 'gif', 'webp', 'tiff', 'he
 
 PHOTO_FILE_EXTENSIONS = RAW_FILE_EXTENSIONS + IMAGE_FILE_EXTENSIONS
 
+FFPROBE = '/usr/bin/ffprobe'
+
+# only request the tags used to date files, keeps exiftool output small
+EXIFTOOL_DATE_ARGS = EXIFTOOL_ARGS + ['-DateTimeOriginal', '-CreateDate']
+
+# seconds before a hung ffprobe is killed
+FFPROBE_TIMEOUT = 60
+
+# format of the dates exiftool is asked to print, see EXIFTOOL_ARGS
+EXIF_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# dates parsed per numpy call, so one malformed date only sends its chunk down the slow path
+PARSE_CHUNK_SIZE = 65536
+
 
 
 def new_event_dir(base, date, date_fmt="%Y/%Y-%m-%d"):
@@ -44,25 +71,71 @@ def new_event_dir(base, date, date_fmt="%Y/%Y-%m-%d"):
 
 
 
-def is_duplicate_file(source, directory):
-    """check for any files in the target directory with the same hash as the source file"""
-    source_hash = sha1(source)
-    for path in ls(directory, relative=False):
-        if sha1(path) == source_hash:
-            return True
-    return False
+class DirectoryIndex(object):
+    """
+    index of the file names and sha1 digests in one directory, so collision checks are set lookups.
+    Names are listed when the index is created, before any copies into the directory start,
+    so only complete files are known: those listed, and those recorded by add() once placed.
+    Digests are only computed at digest lookups, each file once, and outside the lock,
+    so copy workers adding files or checking names are not held up while a directory is hashed.
+    Safe to share between copy workers.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # held while hashing, so concurrent lookups wait for the digests instead of hashing the same files
+        self.hash_lock = threading.Lock()
+        self.names = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        self.digests = set()
+        self.unhashed = [os.path.join(directory, name) for name in sorted(self.names) if not is_event_index(name)]
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.names
+
+    def has_digest(self, digest):
+        """check for any file in the directory with digest"""
+        with self.hash_lock:
+            with self.lock:
+                paths, self.unhashed = self.unhashed, []
+            # subdirectories and other special files are listed by name only
+            digests = [sha1(path) for path in paths if os.path.isfile(path)]
+            with self.lock:
+                self.digests.update(digests)
+                return digest in self.digests
+
+    def add(self, path, digest=None):
+        """record a file placed in the directory; digest is computed at the next lookup if not known"""
+        with self.lock:
+            self.names.add(os.path.basename(path))
+            if digest:
+                self.digests.add(digest)
+            else:
+                self.unhashed.append(path)
 
 
-def get_unique_filename(path):
+
+def is_duplicate_file(source, directory, index=None):
+    """
+    check for any files in the target directory with the same hash as the source file
+    index : DirectoryIndex of directory to reuse across calls
+    """
+    index = index or DirectoryIndex(directory)
+    return index.has_digest(sha1(source))
+
+
+def get_unique_filename(path, index=None):
     """
     find a unique filename based on the path such that the file does not already exist.
     In order to be idempotent, make sure existing files are actually different.
+    index : DirectoryIndex of the directory, used instead of checking each candidate on disk
     """
     dirname = os.path.dirname(path)
     name,ext = os.path.splitext(os.path.basename(path))
     counter = 1
     name_base = name
     path_hash = None
+    exists = (lambda p: os.path.basename(p) in index) if index else os.path.exists
 
     # start counter at value in current filename if any
     name_split = name.rsplit('-',1)
@@ -78,7 +151,7 @@ def get_unique_filename(path):
     for i in range(counter, counter+255):
         new_name = "{b}-{c}{e}".format(b=name_base, c=str(i), e=ext)
         new_path = os.path.join(dirname, new_name)
-        if not os.path.exists(new_path):
+        if not exists(new_path):
             return new_path
 
     else:
@@ -86,29 +159,18 @@ def get_unique_filename(path):
 
 
 
-def exiftool_json(path):
-    """
-    Run exiftool to extract embedded EXIF data from images and movies.
-    Exiftool supports significantly more file types, raw photos, movies than any available python lib
-    Returns json
-    """
-    # make sure the preview file doesn't already exist
-    logger.debug('Running exiftool')
-    p = Popen(['/usr/bin/exiftool', '-recurse', '-dateFormat', "%Y-%m-%d %H:%M:%S", '-json', path], stdout=PIPE, stderr=PIPE)
-    out,err = p.communicate()
-    
-    if err:
-        for msg in err.decode().strip().split('\n'):
-            logger.warning("exiftool: " + msg.strip())
-    return out
-
-
-
-def run_cmd(argcv=[]):
+def run_cmd(argcv=[], timeout=None):
+    """run command and return stdout; the process is killed and TimeoutExpired raised after timeout seconds"""
     program = argcv[0]
     logger.debug('Running {0}'.format(program))
     p = Popen(argcv, stdout=PIPE, stderr=PIPE)
-    out,err = p.communicate()
+    METRICS.count('subprocesses')
+    try:
+        out,err = p.communicate(timeout=timeout)
+    except TimeoutExpired:
+        p.kill()
+        p.communicate()
+        raise
     if err:
         for msg in err.decode().strip().split('\n'):
             logger.warning("{0}: {1}".format(program, msg.strip()))
@@ -116,9 +178,33 @@ def run_cmd(argcv=[]):
 
 
 
-def ffprobe_json(path):
+def ffprobe_json(path, timeout=None):
     """run ffprobe to get metadata from video formats"""
-    return run_cmd(["/usr/bin/ffprobe", "-v", "quiet", "-of", "json", "-show_entries", "format", path])
+    return run_cmd([FFPROBE, "-v", "quiet", "-of", "json", "-show_entries", "format", path], timeout=timeout)
+
+
+def ffprobe_date(path, timeout=FFPROBE_TIMEOUT):
+    """
+    run ffprobe on a video file and return its creation time, or None if unavailable.
+    TimeoutExpired or OSError is raised if ffprobe did not run to completion, so the file can be probed again.
+    """
+    creation_date = None
+    try:
+        with METRICS.timed('ffprobe', path):
+            out = ffprobe_json(path, timeout=timeout)
+    except (TimeoutExpired, OSError) as e:
+        logger.error("ffprobe failed on {0}: {1}".format(path, str(e)))
+        raise
+    try:
+        js = json.loads(out)
+        creation_str = js['format']['tags']['creation_time'] # e.g. 2024-10-27T18:55:15.000000Z
+        creation_date = datetime.strptime(creation_str, '%Y-%m-%dT%H:%M:%S.%fZ')
+    except Exception as e:
+        logger.error("Video without metadata: {0}".format(path))
+        logger.exception(str(e))
+    finally:
+        logger.info("ffprobe {0} --> {1}".format(path, str(creation_date)))
+    return creation_date
 
 
 
@@ -136,146 +222,561 @@ def file_format(path):
 
 
 
-def date_sorted_paths(source_dir):
+class PathDates(object):
     """
-    Run exiftool on source directory and parse photo EXIF data JSON output. 
-    Walk directory and run ffprobe on video files. Then sort and return [(path,date)].
+    compact sorted (path, date) records for a list of paths.
+    Dates are kept as integer microseconds in an array parallel to paths instead of one datetime per file,
+    so memory stays close to the size of the path strings. Iterating yields (path, datetime) in date order.
+    After sort(), files are also available by position in date order with date(k), items() and bisect().
     """
-    path_date_dict = {}
-    photo_count = 0
-    video_count = 0
-    other_count = 0
-    exif_count = 0
-    ffprobe_count = 0
+    __slots__ = ('paths', 'stamps', 'order', 'sorted')
+
+    EPOCH = datetime(1970, 1, 1)
+    NO_DATE = -2**63
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.stamps = array('q', [self.NO_DATE]) * len(paths)
+        self.order = array('q')
+        self.sorted = array('q')
+
+    @classmethod
+    def from_pairs(cls, path_dates):
+        """PathDates of (path, date) pairs already in date order"""
+        pairs = list(path_dates)
+        dates = cls([path for path,date in pairs])
+        for i,(path,date) in enumerate(pairs):
+            dates[i] = date
+        return dates.sort()
+
+    @classmethod
+    def stamp(cls, date):
+        return (date - cls.EPOCH) // timedelta(microseconds=1)
+
+    def __setitem__(self, i, date):
+        self.stamps[i] = self.stamp(date)
+
+    def has_date(self, i):
+        return self.stamps[i] != self.NO_DATE
+
+    def get(self, i):
+        """return the date of paths[i], or None"""
+        if self.has_date(i):
+            return self.EPOCH + timedelta(microseconds=self.stamps[i])
+        return None
+
+    def sort(self):
+        """order dated paths by date; ties keep listing order"""
+        if numpy is not None:
+            stamps = numpy.frombuffer(self.stamps, dtype=numpy.int64)
+            dated = numpy.flatnonzero(stamps != self.NO_DATE)
+            order = dated[numpy.argsort(stamps[dated], kind='stable')].astype(numpy.int64)
+            self.order = array('q', order.tobytes())
+            self.sorted = array('q', stamps[order].tobytes())
+            return self
+        dated = (i for i in range(len(self.paths)) if self.stamps[i] != self.NO_DATE)
+        self.order = array('q', sorted(dated, key=self.stamps.__getitem__))
+        self.sorted = array('q', (self.stamps[i] for i in self.order))
+        return self
+
+    def date(self, k):
+        return self.EPOCH + timedelta(microseconds=self.sorted[k])
+
+    def items(self, start, stop):
+        """yield (path, date) for positions start to stop in date order"""
+        paths = self.paths
+        epoch = self.EPOCH
+        for i,stamp in zip(self.order[start:stop], self.sorted[start:stop]):
+            yield paths[i], epoch + timedelta(microseconds=stamp)
+
+    def bisect(self, date, lo=0):
+        """return the position in date order of the first file dated date or later"""
+        return bisect_left(self.sorted, self.stamp(date), lo)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for i in self.order:
+            yield self.paths[i], self.EPOCH + timedelta(microseconds=self.stamps[i])
+
+
+
+def parse_exif_dates(date_strs):
+    """
+    parse exiftool date strings (EXIF_DATE_FORMAT) into an array of PathDates stamps, NO_DATE where a string is invalid.
+    With numpy the strings are parsed in bulk; any string numpy does not read back identically
+    is parsed with datetime.strptime, so the result is the same with or without numpy.
+    """
+    stamps = array('q')
+    for start in range(0, len(date_strs), PARSE_CHUNK_SIZE):
+        chunk = date_strs[start:start + PARSE_CHUNK_SIZE]
+        slow = range(len(chunk))
+        if numpy is not None:
+            strs = numpy.array(chunk, dtype=str)
+            try:
+                parsed = strs.astype('datetime64[us]')
+            except ValueError:
+                parsed = None
+            if parsed is not None:
+                # numpy also accepts e.g. year 0, dates without a time, or a T separator
+                exact = numpy.datetime_as_string(parsed, unit='s') == numpy.char.replace(strs, ' ', 'T', count=1)
+                exact &= parsed >= numpy.datetime64('0001-01-01')
+                stamps.frombytes(numpy.where(exact, parsed.view(numpy.int64), PathDates.NO_DATE).tobytes())
+                slow = numpy.flatnonzero(~exact).tolist()
+            else:
+                stamps.extend(array('q', [PathDates.NO_DATE]) * len(chunk))
+        else:
+            stamps.extend(array('q', [PathDates.NO_DATE]) * len(chunk))
 
-    # images 
-    try:
-        exif_list = json.loads(exiftool_json(source_dir))
-    except ValueError as e:
-        logger.error("Could not parse exiftool json: {0}".format(str(e)))
-        logger.exception(str(e))
-        sys.exit(1)
+        for i in slow:
+            try:
+                stamps[start + i] = PathDates.stamp(datetime.strptime(chunk[i], EXIF_DATE_FORMAT))
+            except ValueError:
+                pass
+    return stamps
 
-    for exif in exif_list:
-        try:
+
+
+def exiftool_date_strings(paths, exiftool=None):
+    """
+    Run exiftool on paths and select the capture date from its JSON output, one batch at a time.
+    Yield (path, date string) for each file exiftool examined; the date string is None if it has no date metadata.
+    exiftool : ExiftoolPool to reuse; by default a single worker pool is started for this call
+    """
+    pool = exiftool or ExiftoolPool()
+    try:
+        for exif in pool.metadata(paths, EXIFTOOL_DATE_ARGS):
+            path = exif.get('SourceFile')
             # DateTimeOriginal is shutter time; CreateDate is file origination time
             # MTS movies from Sony have DateTimeOriginal
             # AVI movies from Olympus cameras have DateTimeOriginal
-            path = os.path.realpath(exif['SourceFile'])
-            date_str = ''
             if 'DateTimeOriginal' in exif:
-                date_str = exif['DateTimeOriginal']
+                yield path, exif['DateTimeOriginal']
             elif 'CreateDate' in exif:
-                date_str = exif['CreateDate']
+                yield path, exif['CreateDate']
             else:
-                logger.error("EXIF has no CreateDate or DateTimeOriginal for {0}".format(path))
-                continue
+                # other files, e.g. sidecars and documents, are examined too since exiftool may date them, but rarely have dates
+                log = logger.debug if file_format(path) == 'OTHER' else logger.error
+                log("EXIF has no CreateDate or DateTimeOriginal for {0}".format(path))
+                yield path, None
+    finally:
+        if exiftool is None:
+            pool.close()
 
-            creation_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
-            if path not in path_date_dict:
-                path_date_dict[path] = creation_date
-                exif_count += 1
-        
-        except (KeyError, ValueError) as e:
+
+
+def exiftool_dates(paths, exiftool=None):
+    """
+    Run exiftool on paths and parse photo EXIF data JSON output, one batch at a time.
+    Yield (path, date) for each file exiftool examined; date is None if it has no date metadata.
+    exiftool : ExiftoolPool to reuse; by default a single worker pool is started for this call
+    """
+    for path,date_str in exiftool_date_strings(paths, exiftool):
+        if date_str is None:
+            yield path, None
+            continue
+        try:
+            yield path, datetime.strptime(date_str, EXIF_DATE_FORMAT)
+        except ValueError as e:
             logger.error("EXIF {0}: {1}".format(str(e).strip("'"), path))
             logger.exception(str(e))
 
-    # videos
-    for root, dirs, files in os.walk(source_dir):
-        for name in files:
-            format = file_format(name)
-            path = os.path.join(root,name)
 
-            if format == 'VIDEO':
-                video_count += 1
-                creation_date = None
-                try:
-                    out = ffprobe_json(path)
-                    js = json.loads(out)
-                    creation_str = js['format']['tags']['creation_time'] # e.g. 2024-10-27T18:55:15.000000Z
-                    creation_date = datetime.strptime(creation_str, '%Y-%m-%dT%H:%M:%S.%fZ')
-                    if path not in path_date_dict:
-                        path_date_dict[path] = creation_date
-                        ffprobe_count += 1
-                except Exception as e:
-                    logger.error("Video without metadata: {0}".format(path))
-                    logger.exception(str(e))
-                finally:
-                    logger.info("ffprobe {0} --> {1}".format(path, str(creation_date)))
-            
-            elif format == 'PHOTO':
-                photo_count += 1
-                if path not in path_date_dict:
-                    logger.warning("Photo without metadata: {0}".format(path))
-            else:
-                other_count += 1
+
+def date_sorted_paths(source_dir, exiftool=None, jobs=1, timeout=FFPROBE_TIMEOUT, cache=None, scan_jobs=1):
+    """
+    List source directory once, run exiftool on all files and parse photo EXIF data JSON output. 
+    Run ffprobe only on video files that exiftool could not date. Then sort and return PathDates of (path,date).
+    exiftool : ExiftoolPool to reuse; by default a single worker pool is started for this call
+    jobs : number of concurrent ffprobe processes
+    timeout : seconds before a hung ffprobe is killed
+    cache : MetadataCache; only new or changed files are passed to exiftool and ffprobe
+    scan_jobs : number of directories listed concurrently, see scan()
+    """
+    # single directory enumeration shared by exiftool and ffprobe; the cache needs the stat results
+    with METRICS.phase('enumerate'):
+        entries = list(scan(source_dir, isfile=True, stat=cache is not None, jobs=scan_jobs))
+    paths = [entry.path for entry in entries]
+    stats = dict((entry.path, entry.st) for entry in entries) if cache is not None else None
+    # like exiftool -recurse, leave files in hidden directories out of exiftool; their videos still fall back to ffprobe
+    hidden = set(path for path in paths if in_hidden_dir(path, source_dir))
+    return sorted_path_dates(paths, exiftool=exiftool, jobs=jobs, timeout=timeout, cache=cache, stats=stats, skip_exiftool=hidden)
+
+
+
+def in_hidden_dir(path, base):
+    """check if path is below a hidden directory of base"""
+    rel = os.path.relpath(os.path.dirname(path), base)
+    return any(part.startswith('.') and part not in ('.', '..') for part in rel.split(os.sep))
+
 
 
+def sorted_path_dates(paths, exiftool=None, jobs=1, timeout=FFPROBE_TIMEOUT, cache=None, stats=None, skip_exiftool=()):
+    """
+    date a list of files with exiftool, falling back to ffprobe for videos, and return PathDates of (path,date).
+    stats : stat results by path, e.g. from scan(); with a cache, other paths are stat'ed once here
+    skip_exiftool : paths not passed to exiftool
+    see date_sorted_paths()
+    """
+    photo_count = 0
+    video_count = 0
+    other_count = 0
+    exif_count = 0
+    ffprobe_count = 0
+    cache_count = 0
+
+    index = dict((path,i) for i,path in enumerate(paths))
+    dates = PathDates(paths)
+
+    # dates resolved by previous runs
+    cached = set()
+    if cache is not None:
+        stats = dict(stats or {})
+        with METRICS.phase('cache'):
+            for i,path in enumerate(paths):
+                st = stats.get(path)
+                if st is None:
+                    try:
+                        st = stats[path] = os.stat(path)
+                    except OSError as e:
+                        logger.error("{0}: {1}".format(e.strerror, path))
+                        continue
+                entry = cache.get(path, st)
+                if entry:
+                    cached.add(i)
+                    if entry[0]:
+                        dates[i] = entry[0]
+                        cache_count += 1
+        logger.info("Metadata cache: {0} of {1} files".format(len(cached), len(paths)))
+
+    # images and videos with EXIF dates, parsed in bulk once exiftool is done
+    pending = [path for i,path in enumerate(paths) if i not in cached and path not in skip_exiftool]
+    examined = []
+    date_strs = []
+    with METRICS.phase('exiftool'):
+        for path,date_str in exiftool_date_strings(pending, exiftool):
+            i = index.get(path)
+            if i is None:
+                i = index.get(os.path.realpath(path))
+            if i is not None:
+                examined.append(i)
+                date_strs.append(date_str)
+
+    with METRICS.phase('parse'):
+        stamps = parse_exif_dates([date_str or '' for date_str in date_strs])
+    for i,date_str,stamp in zip(examined, date_strs, stamps):
+        if dates.has_date(i):
+            continue
+        if stamp != PathDates.NO_DATE:
+            dates.stamps[i] = stamp
+            exif_count += 1
+        elif date_str is not None:
+            try:
+                datetime.strptime(date_str, EXIF_DATE_FORMAT)
+            except ValueError as e:
+                logger.error("EXIF {0}: {1}".format(str(e).strip("'"), paths[i]))
+                logger.exception(str(e))
+            continue
+        # undated videos are cached after the ffprobe fallback
+        if cache is not None and (dates.has_date(i) or file_format(paths[i]) != 'VIDEO'):
+            cache.put(paths[i], dates.get(i), 'exiftool', stats.get(paths[i]))
+
+    # videos without EXIF dates fall back to ffprobe
+    videos = []
+    for i,path in enumerate(paths):
+        format = file_format(path)
+
+        if format == 'VIDEO':
+            video_count += 1
+            if not dates.has_date(i) and i not in cached:
+                videos.append(i)
+        
+        elif format == 'PHOTO':
+            photo_count += 1
+            if not dates.has_date(i):
+                logger.warning("Photo without metadata: {0}".format(path))
+        else:
+            other_count += 1
+
+    # probe videos concurrently, results are returned in listing order
+    logger.info("ffprobe {0} of {1} videos not dated by exiftool".format(len(videos), video_count))
+    def probe(i):
+        """return (creation date or None, whether ffprobe ran to completion)"""
+        try:
+            return ffprobe_date(paths[i], timeout=timeout), True
+        except (TimeoutExpired, OSError):
+            return None, False
+
+    with METRICS.phase('ffprobe'):
+        for i,(creation_date, probed) in hash_map(videos, probe, jobs=jobs):
+            if creation_date:
+                dates[i] = creation_date
+                ffprobe_count += 1
+            # undated videos are cached too, unless ffprobe hung or failed to start and should be retried
+            if cache is not None and probed:
+                cache.put(paths[i], creation_date, 'ffprobe', stats.get(paths[i]))
+
     logger.info('File statistics: {0} photos, {1} videos, {2} other'.format(photo_count, video_count, other_count))
+    logger.info('Date sources: {0} exiftool, {1} ffprobe, {2} cache'.format(exif_count, ffprobe_count, cache_count))
+    with METRICS.phase('sort'):
+        dates.sort()
     total_media = photo_count + video_count
-    if len(path_date_dict) != total_media:
-        logger.warning("{0} of {1} media files do not have date metadata".format(total_media - len(path_date_dict), total_media))
+    for name,n in [('photos', photo_count), ('videos', video_count), ('other_files', other_count), ('dated_by_exiftool', exif_count),
+                   ('dated_by_ffprobe', ffprobe_count), ('dated_by_cache', cache_count), ('undated_media', total_media - len(dates))]:
+        METRICS.count(name, n)
+    if len(dates) != total_media:
+        logger.warning("{0} of {1} media files do not have date metadata".format(total_media - len(dates), total_media))
     else:
         logger.info("All {0} media files have date metadata".format(total_media))
     
-    return sorted(path_date_dict.items(), key=lambda x: x[1])
+    return dates
+
+
+
+def event_plan(path_dates, dest, day_delta=4, events=None):
+    """
+    group (path,date) sorted by date into events with time delta less than day_delta days from the day of the first file
+    create a directory in dest for each event and return the plan [(path, date, target_path)]
+    path_dates : PathDates, or (path, date) pairs sorted by date
+    events : EventIndex of dest; files join an existing event if within its date range or day_delta days of its start,
+        new events are added to it and the ranges of joined events extended
+    Once the first file of a run is assigned to an event, the rest of the run is found by bisecting for the event limit,
+    so the cost is per event rather than per file.
+    """
+    if not isinstance(path_dates, PathDates):
+        path_dates = PathDates.from_pairs(path_dates)
+    if events is None:
+        # only group the files of this run
+        events = EventIndex(dest)
+
+    plan = []
+    k = 0
+    while k < len(path_dates):
+
+        # join an existing event, or start a new one
+        date = path_dates.date(k)
+        event_dir = events.find(date, day_delta)
+        if event_dir is None:
+            # may be an existing event starting later the same day
+            event_dir = new_event_dir(dest, date)
+        events.add(date, event_dir)
+
+        # every later file dated before the limit joins the same event
+        end = path_dates.bisect(events.limit(event_dir, day_delta), k + 1)
+        events.add(path_dates.date(end - 1), event_dir)
+        # same as os.path.join(event_dir, name), which is slow enough to show with millions of files
+        prefix = os.path.join(event_dir, '')
+        for path,date in path_dates.items(k, end):
+            plan.append((path, date, prefix + os.path.basename(path)))
+        k = end
+
+    return plan
+
+
+
+def target_key(target_path):
+    """
+    targets which get_unique_filename() could rename onto the same path share a key, 
+    e.g. IMG_0001.JPG and IMG_0001-2.JPG in the same event directory
+    """
+    dirname = os.path.dirname(target_path)
+    name,ext = os.path.splitext(os.path.basename(target_path))
+    name_split = name.rsplit('-',1)
+    if len(name_split) == 2 and name_split[1].isdigit():
+        name = name_split[0]
+    return (dirname, name, ext)
 
 
 
-def organize_by_event(source_dir, dest_dir, day_delta=4, hardlink=False, delete=False, rename=False, progress=False, simulate=False):
+def place_file(path, target_path, hardlink=False, delete=False, rename=False, index=None, verify=False, keep_dir=None):
+    """
+    copy path to target_path; if rename, resolve collisions by choosing a different name in the same directory
+    index : DirectoryIndex of the target directory, updated with placed files
+    verify, keep_dir : see copy_file()
+    returns the path the file was placed at, or None if rename found the same file already in the directory.
+    Raises FileCollisionError if the target exists with different content and rename is off.
+    """
+    index = index or DirectoryIndex(os.path.dirname(target_path))
+    try:
+        index.add(target_path, copy_file(path, target_path, hardlink=hardlink, delete=delete, verify=verify, keep_dir=keep_dir))
+        return target_path
+
+    # if there is a collision, choose a different name in the event dir and try again
+    except FileCollisionError as e:
+        if rename:
+            # but first make sure we didn't already do this once; the collision check may have hashed the source already
+            digest = e.digest or sha1(path)
+            if not index.has_digest(digest):
+                renamed_path = get_unique_filename(target_path, index)
+                logger.info("Renamed: {s} --> {t}".format(s=path, t=renamed_path))
+                copy_file(path, renamed_path, hardlink=hardlink, delete=delete, verify=verify, keep_dir=keep_dir, digest=digest)
+                index.add(renamed_path, digest)
+                return renamed_path
+        else:
+            raise
+
+
+
+def transfer_files(plan, hardlink=False, delete=False, rename=False, jobs=1, progress=False, verify=False, journal=None, keep_dir=None):
+    """
+    copy each (path, date, target_path) in plan with up to jobs concurrent copies.
+    Entries whose targets could collide (see target_key) are copied in plan order by a single worker,
+    so the no-overwrite and rename checks of copy_file() and place_file() never race.
+    progress : show files and throughput on stderr
+    verify, keep_dir : see copy_file()
+    journal : TransferPlan; entries it records as done are skipped, newly completed entries are recorded.
+        Entries which fail, e.g. on a collision without rename, are not recorded, so they are retried on resume.
+    returns the number of entries placed, including those the journal records as done
+    """
+    total = len(plan)
+    indexes = {}
+    tasks = multidict()
+    done = 0
+    for count,(path,date,target_path) in enumerate(plan, 1):
+        if journal is not None and count in journal.done:
+            done += 1
+            continue
+        tasks[target_key(target_path)] = (count, path, target_path)
+        event_dir = os.path.dirname(target_path)
+        if event_dir not in indexes:
+            indexes[event_dir] = DirectoryIndex(event_dir)
+
+    pending = sum(len(task) for task in tasks.values())
+    meter = Progress(pending) if progress else None
+
+    def run(task):
+        placed = []
+        for count,path,target_path in task:
+            # an interrupted --delete run may have already moved the file
+            if journal is not None and not os.path.exists(path) and os.path.isfile(target_path):
+                logger.warning("Source already moved: {s} --> {t}".format(s=path, t=target_path))
+                placed.append((count, target_path))
+                size = 0
+            else:
+                logger.info("Copying ({c}/{n}): {s} --> {t}".format(c=count, n=total, s=path, t=target_path))
+                size = os.path.getsize(path)
+                try:
+                    placed.append((count, place_file(path, target_path, hardlink=hardlink, delete=delete, rename=rename, index=indexes[os.path.dirname(target_path)], verify=verify, keep_dir=keep_dir)))
+                except FileCollisionError as e:
+                    logger.exception(str(e))
+                # the bad copy was removed and the source kept, carry on with the other files
+                except CopyVerificationError as e:
+                    logger.error(str(e).strip())
+            if meter:
+                meter.update(1, size)
+        return placed
+
+    for task,placed in hash_map(list(tasks.values()), run, jobs=jobs):
+        for count,target_path in placed:
+            if target_path is not None:
+                done += 1
+            if journal is not None:
+                journal.complete(count, target_path)
+    if meter:
+        meter.close()
+    return done
+
+
+
+def organize_by_event(source_dir, dest_dir, day_delta=4, hardlink=False, delete=False, rename=False, progress=False, simulate=False, exiftool=None, jobs=1, timeout=FFPROBE_TIMEOUT, metadata_cache=None, copy_jobs=1, verify=False, plan_file=None, rescan_events=False, scan_jobs=1):
     """
     walk files in source_dir and extract CreateDate from EXIF data using Exiftool
     Sort files by date and group into collection with time delta less than 4 days between
-    copy files into dest_dir with a new directory for each collection
+    copy files into dest_dir with a new directory for each collection,
+    or into an existing event of dest_dir (see EventIndex) if a file falls within its range or gap
+    exiftool, jobs, timeout, scan_jobs : metadata extraction options, see date_sorted_paths()
+    metadata_cache : MetadataCache of capture dates from previous runs
+    copy_jobs : number of concurrent copies, see transfer_files()
+    verify : hash data while copying and compare with the destination read back before deleting the source
+    plan_file : path of a TransferPlan. If it exists, resume it without reading metadata again,
+        otherwise write the plan there and journal completed transfers to it (with simulate, only write it)
+    rescan_events : rebuild the EventIndex of dest_dir from its directory names instead of loading it
     """
-    count = 0
-    event_date = None
-    event_dir = None
     dest = os.path.realpath(dest_dir)
     source = os.path.realpath(source_dir)
-    
-    # walk the filesystem, read metadata
-    path_dates = date_sorted_paths(source)
-    total = len(path_dates)
-
-    # iterate over (date,path) sorted by date
-    for path,date in path_dates:
-        count += 1
-        
-        # first iteration: initialize date and create event dir
-        if not event_date: 
-            event_date = date
-            event_dir = new_event_dir(dest, event_date)
-
-        # decide if time delta is large enough to start a new event
-        delta = date - event_date 
-        if delta.days > day_delta:
-            # new event, create event directory 
-            event_date = date
-            event_dir = new_event_dir(dest, event_date)
-
-        # copy file to event_dir 
-        target_path = os.path.join(event_dir, os.path.basename(path))
+    journal = None
+
+    if plan_file and os.path.exists(plan_file):
+        with METRICS.phase('plan'):
+            journal = TransferPlan.load(plan_file)
+        if (journal.source, journal.dest) != (source, dest):
+            journal.close()
+            raise Exception('Plan file {0} is for {1} --> {2}'.format(plan_file, journal.source, journal.dest))
+        plan = journal.entries
+        logger.info("Resuming plan {0}: {1} of {2} files already done".format(plan_file, len(journal.done), len(plan)))
         if not simulate:
-            try:
-                logger.info("Copying ({c}/{n}): {s} --> {t}".format(c=count, n=total, s=source, t=target_path))
-                copy_file(path, target_path, hardlink=hardlink, delete=delete)
-
-            # if there is a collision, choose a different name in the event dir and try again
-            except FileCollisionError as e:
-                if rename:
-                    # but first make sure we didn't already do this once
-                    if not is_duplicate_file(path, event_dir):
-                        renamed_path = get_unique_filename(target_path)
-                        logger.info("Copying ({c}/{n}): {s} --> {t}".format(c=count, n=total, s=source, t=target_path))
-                        copy_file(path, renamed_path, hardlink=hardlink, delete=delete)
-                else:
-                    logger.exception(str(e))
+            # the plan may have been saved by --simulate, which left the event index alone
+            with METRICS.phase('group'):
+                events = EventIndex.load(dest, rescan=rescan_events)
+                for path,date,target in plan:
+                    events.add(date, os.path.dirname(target))
+                events.close()
 
-            # update progress, use carriage return to update terminal line
-            #if progress: sys.stderr.write("{0}/{1}         \r".format(count, total))
+    else:
+        # walk the filesystem, read metadata
+        path_dates = date_sorted_paths(source, exiftool=exiftool, jobs=jobs, timeout=timeout, cache=metadata_cache, scan_jobs=scan_jobs)
+
+        # group into new or existing events
+        with METRICS.phase('group'):
+            events = EventIndex.load(dest, rescan=rescan_events, simulate=simulate)
+            plan = event_plan(path_dates, dest, day_delta, events)
+            events.close()
+        if plan_file:
+            journal = TransferPlan(plan, source, dest)
+            journal.save(plan_file)
+            logger.info("Saved plan of {0} files to {1}".format(len(plan), plan_file))
+
+    # copy
+    try:
+        if simulate:
+            return
+        with METRICS.phase('copy'):
+            done = transfer_files(plan, hardlink=hardlink, delete=delete, rename=rename, jobs=copy_jobs, progress=progress, verify=verify, journal=journal)
+    finally:
+        if journal is not None:
+            journal.close()
 
-    logger.info("Copied {0} of {1} files with date metadata".format(count, total))
+    logger.info("Copied {0} of {1} files with date metadata".format(done, len(plan)))
+
+
+
+def watch_by_event(source_dir, dest_dir, day_delta=4, hardlink=False, delete=False, rename=False, simulate=False, exiftool=None, jobs=1, timeout=FFPROBE_TIMEOUT, metadata_cache=None, copy_jobs=1, verify=False, settle=10, interval=5, batch_size=EXIFTOOL_BATCH_SIZE, polling=False, rescan_events=False):
+    """
+    watch source_dir and organize files into the events of dest_dir as they finish arriving, until interrupted.
+    A file is processed once it has not changed for settle seconds, in batches of at most batch_size files.
+    Files join an existing event in dest_dir if within its date range or day_delta days of its start, otherwise start a new event.
+    source_dir itself is never removed, even if delete empties it.
+    interval : seconds between scans when inotify is unavailable or polling
+    other options : see organize_by_event()
+    """
+    dest = os.path.realpath(dest_dir)
+    source = os.path.realpath(source_dir)
+
+    events = EventIndex.load(dest, rescan=rescan_events, simulate=simulate)
+    watcher = make_watcher(source, settle, interval, polling)
+    logger.info("Watching {0}".format(source))
+
+    try:
+        while True:
+            watcher.wait()
+            for batch in batches(watcher.settled(), batch_size):
+                path_dates = sorted_path_dates(batch, exiftool=exiftool, jobs=jobs, timeout=timeout, cache=metadata_cache)
+                with METRICS.phase('group'):
+                    plan = event_plan(path_dates, dest, day_delta, events)
+                done = 0
+                if not simulate:
+                    with METRICS.phase('copy'):
+                        done = transfer_files(plan, hardlink=hardlink, delete=delete, rename=rename, jobs=copy_jobs, verify=verify, keep_dir=source)
+                    events.flush()
+                # a long running watch should not lose the cache to a crash
+                if metadata_cache is not None:
+                    metadata_cache.commit()
+                logger.info("Copied {0} of {1} new files".format(done, len(batch)))
+    except KeyboardInterrupt:
+        logger.info("Stopped watching {0}".format(source))
+    finally:
+        watcher.close()
 
 
 
@@ -290,10 +791,31 @@ def photorg_main():
     parser.add_argument('--quiet', action='store_true', help='Supress STDERR messages; e.g. use when logging to syslog or file')
     parser.add_argument('--hardlink', action='store_true', help='hardlink instead of copy')
     parser.add_argument('--delete', action='store_true', help='delete source file after copy')
+    parser.add_argument('--verify', action='store_true', help='Hash data while copying and compare with the destination read back from disk before deleting the source')
     parser.add_argument('--rename', action='store_true', help='Resolve collisions (same path, different content) by renaming file')
+    parser.add_argument('--payload', action='store_true', help='Compare only the image and video data in collision checks, so a copy whose metadata was edited is not copied again (JPEG, PNG, MP4/MOV; other files are compared in full)')
     parser.add_argument('--progress', action='store_true', help='show progress')
     parser.add_argument('--simulate', action='store_true', help='No action; only perform a simulation of events that would occur')
+    parser.add_argument('--plan', metavar='FILE', help='Transfer plan and journal. Resumes FILE if it exists, otherwise saves the plan to FILE (with --simulate, only saves it)')
+    parser.add_argument('--rescan-events', action='store_true', help='Rebuild the index of existing events in DEST (DEST/{0}) from its directory names'.format(EVENT_INDEX_NAME))
+    parser.add_argument('--watch', action='store_true', help='Keep running and organize files as they arrive in SOURCE into new or existing events in DEST')
+    parser.add_argument('--settle', type=float, default=10, help='With --watch, seconds a file must be unchanged before it is organized (default 10)')
+    parser.add_argument('--poll-interval', type=float, default=5, help='With --watch, seconds between scans of SOURCE when inotify is unavailable (default 5)')
+    parser.add_argument('--poll', action='store_true', help='With --watch, scan SOURCE every --poll-interval instead of using inotify, e.g. for network filesystems')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of concurrent exiftool and ffprobe processes (default 1)')
+    parser.add_argument('--scan-jobs', type=int, default=1, help='Number of directories of SOURCE listed concurrently, e.g. 8 to hide the latency of network filesystems (default 1)')
+    parser.add_argument('--copy-jobs', type=int, default=1, help='Number of concurrent file copies (default 1)')
+    parser.add_argument('--probe-timeout', type=int, default=FFPROBE_TIMEOUT, help='Seconds before a hung ffprobe is killed (default {0})'.format(FFPROBE_TIMEOUT))
+    parser.add_argument('--cache', action='store_true', help='Cache SHA1 digests used for collision checks and reuse them in subsequent invocations')
+    parser.add_argument('--cache-file', default=default_cache_path(), help='Location of the digest cache (default {0})'.format(default_cache_path()))
+    parser.add_argument('--metadata-cache', action='store_true', help='Cache capture dates so only new or changed files are passed to exiftool and ffprobe')
+    parser.add_argument('--metadata-cache-file', default=default_cache_path('metadata.sqlite'), help='Location of the metadata cache (default {0})'.format(default_cache_path('metadata.sqlite')))
+    parser.add_argument('--metadata-cache-size', type=int, default=1000000, help='Maximum number of metadata cache entries; least recently used are evicted (default 1000000)')
+    parser.add_argument('--stats-file', metavar='FILE', help='At exit, write phase timings, byte and file counts, subprocess latencies and the slowest files to FILE as JSON, or in the Prometheus text format if FILE ends in .prom')
     args = parser.parse_args()
+
+    if args.watch and (args.plan or args.progress or args.scan_jobs != 1):
+        parser.error('--plan, --progress and --scan-jobs apply to a single run; they can not be used with --watch')
    
     # set log level
     level = logging.ERROR
@@ -325,22 +847,74 @@ def photorg_main():
         sysh.setFormatter(logging.Formatter('%(name)s [%(levelname)s] %(message)s'))
         logger.addHandler(sysh)
 
+    cache = None
+    if args.cache:
+        cache = DigestCache(args.cache_file)
+        set_digest_cache(cache)
+
+    if args.payload:
+        set_digest_mode('payload')
+
+    metadata_cache = None
+    if args.metadata_cache:
+        metadata_cache = MetadataCache(args.metadata_cache_file, max_entries=args.metadata_cache_size)
+
+    status = 'error'
     try:
         logger.info("photorg start")
         # organize and copy files from SOURCE into DEST
-        organize_by_event(args.SOURCE, args.DEST, 
-                day_delta=args.gap, 
-                hardlink=args.hardlink, 
-                delete=args.delete, 
-                rename=args.rename, 
-                progress=args.progress,
-                simulate=args.simulate)
+        with ExiftoolPool(workers=args.jobs) as exiftool:
+            if args.watch:
+                watch_by_event(args.SOURCE, args.DEST,
+                        day_delta=args.gap,
+                        hardlink=args.hardlink,
+                        delete=args.delete,
+                        rename=args.rename,
+                        simulate=args.simulate,
+                        exiftool=exiftool,
+                        jobs=args.jobs,
+                        timeout=args.probe_timeout,
+                        metadata_cache=metadata_cache,
+                        copy_jobs=args.copy_jobs,
+                        verify=args.verify,
+                        settle=args.settle,
+                        interval=args.poll_interval,
+                        polling=args.poll,
+                        rescan_events=args.rescan_events)
+            else:
+                organize_by_event(args.SOURCE, args.DEST,
+                        day_delta=args.gap,
+                        hardlink=args.hardlink,
+                        delete=args.delete,
+                        rename=args.rename,
+                        progress=args.progress,
+                        simulate=args.simulate,
+                        exiftool=exiftool,
+                        jobs=args.jobs,
+                        timeout=args.probe_timeout,
+                        metadata_cache=metadata_cache,
+                        copy_jobs=args.copy_jobs,
+                        verify=args.verify,
+                        plan_file=args.plan,
+                        rescan_events=args.rescan_events,
+                        scan_jobs=args.scan_jobs)
         logger.info("photorg done") 
+        status = 'ok'
     
     except Exception as e:
         logger.exception('Unhandled exception')
         logger.exception(e)
 
+    finally:
+        if cache is not None:
+            set_digest_cache(None)
+            cache.close()
+        set_digest_mode('file')
+        if metadata_cache is not None:
+            metadata_cache.close()
+        if args.stats_file:
+            write_stats(args.stats_file, status, cache, metadata_cache)
+
 
 
 if __name__ == '__main__':
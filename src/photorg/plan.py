@@ -0,0 +1,85 @@
+"""
+transfer plan and journal for resumable photorg runs
+"""
+
+import os
+import json
+import logging
+from datetime import datetime
+
+logger = logging.getLogger('photorg')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class TransferPlan(object):
+    """
+    a plan of file transfers [(source, date, target)] stored as JSON lines.
+    The file starts with a header naming the source and destination directories, followed by one line per entry.
+    As entries complete a journal line is appended to the same file,
+    so an interrupted run can be resumed by loading the plan and skipping completed entries.
+    Entries are numbered from 1 in plan order.
+    """
+
+    def __init__(self, entries, source=None, dest=None):
+        self.entries = entries
+        self.source = source
+        self.dest = dest
+        self.done = {}
+        self.file = None
+
+    @classmethod
+    def load(cls, path):
+        """read a plan file and its journal of completed entries"""
+        plan = cls([])
+        # end of the last complete record
+        end = 0
+        last = b''
+        with open(path, 'rb') as f:
+            for line in f:
+                # an interrupted write may leave a partial last line
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Ignoring partial plan record: {0}".format(line.decode(errors='replace').strip()))
+                    continue
+                end = f.tell()
+                last = line
+                if 'plan' in record:
+                    plan.source = record['source']
+                    plan.dest = record['dest']
+                elif 'state' in record:
+                    plan.done[record['entry']] = record.get('target')
+                else:
+                    date = datetime.strptime(record['date'], DATE_FORMAT)
+                    plan.entries.append((record['source'], date, record['target']))
+        # drop a partial last record, so the records journaled on resume start on a line of their own
+        plan.file = open(path, 'a')
+        plan.file.truncate(end)
+        if last and not last.endswith(b'\n'):
+            plan.file.write('\n')
+        return plan
+
+    def save(self, path):
+        """write the plan to path and keep it open to journal completed entries"""
+        self.file = open(path, 'w')
+        self.write({'plan': 1, 'source': self.source, 'dest': self.dest})
+        for n,(source, date, target) in enumerate(self.entries, 1):
+            self.write({'entry': n, 'source': source, 'date': date.strftime(DATE_FORMAT), 'target': target})
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+
+    def complete(self, n, target=None):
+        """journal entry n as done; target is where the file was placed, None if it was skipped as a duplicate"""
+        self.done[n] = target
+        if self.file:
+            self.write({'entry': n, 'state': 'done', 'target': target})
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
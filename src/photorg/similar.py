@@ -0,0 +1,162 @@
+"""
+perceptual hashes of photos and near-duplicate search, for the same picture re-exported, resized,
+recompressed or with its metadata rewritten
+"""
+
+import os
+import logging
+
+# optional, decodes images for --similar
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('photorg')
+
+
+# dHash of HASH_SIZE x HASH_SIZE bits
+HASH_SIZE = 8
+
+# default maximum number of differing bits, out of HASH_SIZE**2, for two photos to be similar
+SIMILAR_DISTANCE = 6
+
+
+def dhash(path, size=HASH_SIZE):
+    """
+    return the difference hash of the image at path as an int of size*size bits, or None if it can not be decoded.
+    The image is reduced to size+1 by size grey pixels and each bit records whether a pixel is brighter than its right neighbour,
+    so the hash survives resizing, recompression and rewritten metadata, but not cropping.
+    EXIF orientation is applied first, so a re-export which rotated the pixels hashes the same.
+    """
+    try:
+        with Image.open(path) as img:
+            # JPEG is decoded at 1/2 to 1/8 scale where that is still larger than needed, much cheaper than a full decode
+            img.draft('L', (size * 8, size * 8))
+            img = ImageOps.exif_transpose(img)
+            pixels = img.convert('L').resize((size + 1, size), Image.BILINEAR).tobytes()
+    except Exception as e:
+        # PIL raises OSError, ValueError, DecompressionBombError, ... for files it can not read
+        logger.warning("Can not hash image {0}: {1}".format(path, e))
+        return None
+
+    value = 0
+    for row in range(size):
+        for col in range(row * (size + 1), row * (size + 1) + size):
+            value = value << 1 | (pixels[col] > pixels[col + 1])
+    return value
+
+
+def image_hash(path, st=None, cache=None):
+    """
+    return dhash(path), from cache if current
+    st : stat result of path if already known
+    cache : ImageHashCache
+    """
+    if cache is None:
+        return dhash(path)
+    st = st or os.stat(path)
+    value = cache.get(st)
+    if value is None:
+        value = dhash(path)
+        if value is not None:
+            cache.put(path, st, value)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def combinations_count(n, r):
+    """number of ways to choose up to r of n bits"""
+    count = 0
+    term = 1
+    for k in range(r + 1):
+        count += term
+        term = term * (n - k) // (k + 1)
+    return count
+
+
+class HammingIndex(object):
+    """
+    multi-index hashing: the bits of each hash are split into chunks, with a table per chunk.
+    Two hashes within distance d differ in at most d // chunks bits of at least one chunk (pigeonhole),
+    so a search only compares the hashes filed under chunk values within d // chunks bits of the query's.
+    The number of chunks is chosen for the expected number of hashes, trading probes per chunk for hashes per probe,
+    so the cost of a search stays small instead of growing with the number of hashes.
+    Equal hashes are stored once, with all their items.
+    """
+
+    def __init__(self, bits=HASH_SIZE * HASH_SIZE, distance=SIMILAR_DISTANCE, expected=1000):
+        self.distance = distance
+        cost = lambda m: m * combinations_count(bits // m, distance // m) * (1 + expected / float(2 ** (bits // m)))
+        chunks = min(range(1, min(distance + 1, bits) + 1), key=cost)
+        self.radius = distance // chunks
+        self.chunks = []
+        shift = 0
+        for j in range(chunks):
+            width = bits // chunks + (j < bits % chunks)
+            self.chunks.append((shift, (1 << width) - 1, flips(width, self.radius), {}))
+            shift += width
+        self.items = {}
+
+    def add(self, value, item):
+        items = self.items.get(value)
+        if items is None:
+            items = self.items[value] = []
+            for shift,mask,masks,table in self.chunks:
+                table.setdefault(value >> shift & mask, []).append(value)
+        items.append(item)
+
+    def search(self, value):
+        """yield (hash, items) of each stored hash within distance of value"""
+        seen = set()
+        for shift,mask,masks,table in self.chunks:
+            chunk = value >> shift & mask
+            for flip in masks:
+                for other in table.get(chunk ^ flip, ()):
+                    if other not in seen:
+                        seen.add(other)
+                        if hamming(value, other) <= self.distance:
+                            yield other, self.items[other]
+
+
+def flips(width, radius):
+    """xor masks with up to radius of the low width bits set"""
+    masks = {0}
+    for r in range(radius):
+        masks |= set(m | 1 << b for m in masks for b in range(width))
+    return sorted(masks)
+
+
+def similar_groups(hashes, distance=SIMILAR_DISTANCE):
+    """
+    group items whose hashes are within distance of each other, directly or through other items.
+    hashes : list of (item, hash) pairs; items with hash None are ignored
+    returns lists of items with more than one member, each in input order, ordered by their first item
+    """
+    index = HammingIndex(distance=distance, expected=len(hashes))
+    parent = {}
+
+    def find(value):
+        while parent[value] != value:
+            parent[value] = parent[parent[value]]
+            value = parent[value]
+        return value
+
+    # each new hash is linked to all earlier hashes near it, so every near pair is seen once
+    for i,(item,value) in enumerate(hashes):
+        if value is None:
+            continue
+        if value not in parent:
+            parent[value] = value
+            for other,items in index.search(value):
+                parent[find(other)] = find(value)
+        index.add(value, i)
+
+    groups = {}
+    for i,(item,value) in enumerate(hashes):
+        if value is not None:
+            groups.setdefault(find(value), []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
@@ -0,0 +1,194 @@
+"""
+watch a directory for files which have finished arriving
+"""
+
+import os
+import stat
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+from .common import scan, scan_dir
+
+logger = logging.getLogger('photorg')
+
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class PollingWatcher(object):
+    """
+    find files under directory which are new or changed, and then have not changed for settle seconds,
+    by scanning the whole directory every interval seconds.
+    Hidden files are ignored; sync tools write partial files under hidden temporary names.
+    Files present when the watcher starts are reported as new.
+    """
+
+    def __init__(self, directory, settle=10, interval=5):
+        self.directory = directory
+        self.settle = settle
+        self.interval = interval
+        # path -> (size, mtime_ns) when last observed
+        self.seen = {}
+        # path -> time of the last observed change, for files not reported since
+        self.changed = {}
+        # path -> (size, mtime_ns) when last reported
+        self.reported = {}
+        self.scan(time.monotonic())
+
+    def observe(self, path, now, st=None):
+        """stat path, unless st is given, and note it as changed if it differs from the last observation"""
+        if os.path.basename(path).startswith('.'):
+            return
+        try:
+            st = st or os.stat(path)
+        except OSError:
+            # removed, e.g. moved to DEST by --delete
+            self.forget(path)
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        state = (st.st_size, st.st_mtime_ns)
+        if self.seen.get(path) != state:
+            self.seen[path] = state
+            if self.reported.get(path) != state:
+                self.changed[path] = now
+
+    def forget(self, path):
+        self.seen.pop(path, None)
+        self.changed.pop(path, None)
+        self.reported.pop(path, None)
+
+    def scan(self, now):
+        present = set()
+        for entry in scan(self.directory, hidden=False, isfile=True, stat=True):
+            present.add(entry.path)
+            self.observe(entry.path, now, entry.st)
+        for path in [p for p in self.seen if p not in present]:
+            self.forget(path)
+
+    def wait(self):
+        """wait up to interval seconds for changes"""
+        time.sleep(self.interval)
+        self.scan(time.monotonic())
+
+    def settled(self):
+        """return sorted paths which have not changed for settle seconds, each is reported once per change"""
+        now = time.monotonic()
+        # stat again to catch writes since the last event or scan
+        for path in list(self.changed):
+            self.observe(path, now)
+        ready = sorted(path for path,t in self.changed.items() if now - t >= self.settle)
+        for path in ready:
+            del self.changed[path]
+            self.reported[path] = self.seen[path]
+        return ready
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+    """
+    PollingWatcher driven by inotify events instead of full scans.
+    Every directory in the tree is watched, including directories created later.
+    If the kernel event queue overflows the whole tree is scanned once.
+    """
+
+    def __init__(self, directory, settle=10, interval=5):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+        PollingWatcher.__init__(self, directory, settle, interval)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            logger.warning("Could not watch {0}: {1}".format(directory, os.strerror(errno)))
+            return
+        self.watches[wd] = directory
+
+    def scan(self, now):
+        """watch every directory under self.directory and observe their files"""
+        self.scan_tree(self.directory, now)
+
+    def scan_tree(self, directory, now):
+        stack = [directory]
+        while stack:
+            root = stack.pop()
+            # watch before listing, so a file created meanwhile is either listed or reported
+            self.add_watch(root)
+            files, dirs = scan_dir(root, hidden=False, isfile=True, stat=True)
+            for entry in files:
+                self.observe(entry.path, now, entry.st)
+            stack.extend(reversed(dirs))
+
+    def wait(self):
+        """wait up to interval seconds for inotify events and observe the files they name"""
+        readable,_,_ = select.select([self.fd], [], [], self.interval)
+        if not readable:
+            return
+        now = time.monotonic()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0')
+                offset += INOTIFY_EVENT.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflow; rescanning {0}".format(self.directory))
+                    PollingWatcher.scan(self, now)
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None or not name:
+                    continue
+
+                path = os.path.join(directory, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith('.'):
+                        self.scan_tree(path, now)
+                else:
+                    self.observe(path, now)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(directory, settle=10, interval=5, polling=False):
+    """return an InotifyWatcher for directory, or a PollingWatcher if inotify is unavailable or polling"""
+    if not polling:
+        try:
+            return InotifyWatcher(directory, settle, interval)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable ({0}); polling instead".format(e))
+    return PollingWatcher(directory, settle, interval)
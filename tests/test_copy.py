@@ -0,0 +1,92 @@
+import os
+import errno
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from photorg import common
+from photorg.common import copy_file
+from photorg.photorg import transfer_files
+
+
+def test_concurrent_deletes_empty_the_source_directory(tmp_path, monkeypatch):
+    source = tmp_path / 'src' / 'trip'
+    dest = tmp_path / 'dest'
+    source.mkdir(parents=True)
+    dest.mkdir()
+    for name in ('a.jpg', 'b.jpg'):
+        (source / name).write_bytes(name.encode())
+
+    # both copies delete their source before either lists the directory,
+    # and one lists it only after the other removed it
+    listdir = os.listdir
+    barrier = threading.Barrier(2, timeout=5)
+    def racing_listdir(path):
+        if path == str(source) and barrier.wait():
+            threading.Event().wait(0.2)
+        return listdir(path)
+    monkeypatch.setattr(os, 'listdir', racing_listdir)
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(copy_file, str(source / name), str(dest / name), delete=True) for name in ('a.jpg', 'b.jpg')]
+        for future in futures:
+            future.result()
+    assert sorted(os.listdir(str(dest))) == ['a.jpg', 'b.jpg']
+    assert not source.exists()
+
+
+def unsupported(src, dst, size):
+    raise OSError(errno.EOPNOTSUPP, 'not supported')
+
+
+def stops_early(name):
+    def copy(src, dst, size):
+        # a partial copy, with the file offsets moved as an in-kernel copy would
+        data = os.read(src, size // 2)
+        os.write(dst, data[:len(data) // 2])
+        raise common.copy_incomplete(name, size - len(data) // 2)
+    return copy
+
+
+@pytest.mark.parametrize('methods,used', [
+    ([('reflink', unsupported), ('copy_file_range', stops_early('copy_file_range')), ('sendfile', common.copy_sendfile), ('userspace', common.copy_userspace)], 'sendfile'),
+    ([('reflink', unsupported), ('copy_file_range', stops_early('copy_file_range')), ('sendfile', stops_early('sendfile')), ('userspace', common.copy_userspace)], 'userspace'),
+])
+def test_copy_falls_back_after_partial_copies(tmp_path, monkeypatch, methods, used):
+    data = bytes(range(256)) * 1000 + b'tail'
+    (tmp_path / 'source').write_bytes(data)
+    monkeypatch.setattr(common, 'COPY_METHODS', methods)
+    assert common.copy_data(str(tmp_path / 'source'), str(tmp_path / 'target')) == used
+    assert (tmp_path / 'target').read_bytes() == data
+
+
+def test_failed_copy_removes_target(tmp_path, monkeypatch):
+    (tmp_path / 'source').write_bytes(b'photo')
+    def broken(src, dst, size):
+        os.write(dst, b'ph')
+        raise OSError(errno.EIO, 'I/O error')
+    monkeypatch.setattr(common, 'COPY_METHODS', [('reflink', unsupported), ('copy_file_range', broken), ('userspace', common.copy_userspace)])
+    with pytest.raises(OSError) as e:
+        common.copy_data(str(tmp_path / 'source'), str(tmp_path / 'target'))
+    assert e.value.errno == errno.EIO
+    assert not (tmp_path / 'target').exists()
+
+
+def test_verification_mismatch_keeps_source_and_continues(tmp_path, monkeypatch):
+    source = tmp_path / 'src'
+    source.mkdir()
+    dest = tmp_path / 'dest'
+    for name in ('bad.jpg', 'good.jpg'):
+        (source / name).write_bytes(name.encode())
+    # the read back of one target differs from the data copied
+    sha1_file = common.sha1_file
+    monkeypatch.setattr(common, 'sha1_file', lambda path: 'corrupt' if path == str(dest / 'bad.jpg') else sha1_file(path))
+
+    plan = [(str(source / name), datetime(2024, 1, 1), str(dest / name)) for name in ('bad.jpg', 'good.jpg')]
+    assert transfer_files(plan, delete=True, verify=True) == 1
+    assert not (dest / 'bad.jpg').exists()
+    assert (source / 'bad.jpg').read_bytes() == b'bad.jpg'
+    assert (dest / 'good.jpg').read_bytes() == b'good.jpg'
+    assert not (source / 'good.jpg').exists()
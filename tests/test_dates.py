@@ -0,0 +1,110 @@
+import os
+import random
+from datetime import datetime, timedelta
+from subprocess import TimeoutExpired
+
+import pytest
+
+from photorg import photorg
+from photorg.photorg import PathDates, parse_exif_dates, event_plan, new_event_dir, sorted_path_dates, EXIF_DATE_FORMAT
+from photorg.cache import MetadataCache
+
+
+DATE_STRS = ['2021-03-04 05:06:07', '1999-12-31 23:59:59', '2021-02-29 00:00:00', '0000-01-01 00:00:00',
+             '2021-03-04', '2021-03-04T05:06:07', '0000:00:00 00:00:00', '', 'garbage', '9999-12-31 23:59:59']
+
+
+@pytest.fixture
+def no_numpy(monkeypatch):
+    monkeypatch.setattr(photorg, 'numpy', None)
+
+
+def strptime_stamps(date_strs):
+    stamps = []
+    for s in date_strs:
+        try:
+            stamps.append(PathDates.stamp(datetime.strptime(s, EXIF_DATE_FORMAT)))
+        except ValueError:
+            stamps.append(PathDates.NO_DATE)
+    return stamps
+
+
+def sample_dates(count, seed=1):
+    rng = random.Random(seed)
+    base = datetime(2020, 1, 1)
+    # many equal dates, so sorting ties are checked too
+    return [base + timedelta(minutes=rng.randrange(0, 60 * 24 * 90, 7)) for i in range(count)]
+
+
+def test_parse_without_numpy_matches_strptime(no_numpy):
+    assert list(parse_exif_dates(DATE_STRS)) == strptime_stamps(DATE_STRS)
+
+
+def test_parse_with_numpy_matches_strptime():
+    pytest.importorskip('numpy')
+    assert list(parse_exif_dates(DATE_STRS)) == strptime_stamps(DATE_STRS)
+
+
+def test_sort_with_numpy_matches_python(monkeypatch):
+    numpy = pytest.importorskip('numpy')
+    dates = sample_dates(2000)
+    paths = ['/src/{0}.jpg'.format(i) for i in range(len(dates))]
+
+    def sort():
+        path_dates = PathDates(paths)
+        for i,date in enumerate(dates):
+            if i % 10:
+                path_dates[i] = date
+        return list(path_dates.sort())
+
+    bulk = sort()
+    monkeypatch.setattr(photorg, 'numpy', None)
+    assert bulk == sort()
+    assert bulk == sorted(((path, date) for i,(path,date) in enumerate(zip(paths, dates)) if i % 10), key=lambda pair: pair[1])
+
+
+def reference_plan(path_dates, dest, day_delta):
+    """the per-file rule of photorg before event_plan(): a new event once a file is more than day_delta days after the first file of the event"""
+    plan = []
+    event_date = None
+    for path,date in path_dates:
+        if event_date is None or (date - event_date).days > day_delta:
+            event_date = date
+            event_dir = new_event_dir(dest, event_date)
+        plan.append((path, date, event_dir + '/' + path.rsplit('/', 1)[1]))
+    return plan
+
+
+@pytest.mark.parametrize('day_delta', [0, 1, 4])
+def test_event_plan_matches_per_file_grouping(tmp_path, day_delta):
+    dates = sorted(sample_dates(3000))
+    path_dates = [('/src/{0}.jpg'.format(i), date) for i,date in enumerate(dates)]
+    assert event_plan(path_dates, str(tmp_path), day_delta) == reference_plan(path_dates, str(tmp_path), day_delta)
+
+
+def test_event_gap_starts_at_the_first_file(tmp_path):
+    path_dates = [('/src/a.jpg', datetime(2024, 1, 1, 20)), ('/src/b.jpg', datetime(2024, 1, 6, 10)), ('/src/c.jpg', datetime(2024, 1, 6, 21))]
+    plan = event_plan(path_dates, str(tmp_path), 4)
+    assert plan == reference_plan(path_dates, str(tmp_path), 4)
+    assert [target.rsplit('/', 2)[1] for path,date,target in plan] == ['2024-01-01', '2024-01-01', '2024-01-06']
+
+
+def test_undated_videos_are_cached_unless_ffprobe_timed_out(tmp_path, monkeypatch):
+    paths = []
+    for name in ('undated.mp4', 'hung.mp4'):
+        (tmp_path / name).write_bytes(b'video')
+        paths.append(str(tmp_path / name))
+    probed = []
+    def ffprobe_json(path, timeout=None):
+        probed.append(os.path.basename(path))
+        if 'hung' in path:
+            raise TimeoutExpired('ffprobe', timeout)
+        return '{"format": {}}'
+    monkeypatch.setattr(photorg, 'exiftool_date_strings', lambda paths, exiftool=None: iter(()))
+    monkeypatch.setattr(photorg, 'ffprobe_json', ffprobe_json)
+
+    cache = MetadataCache(str(tmp_path / 'metadata.sqlite'))
+    for run in range(2):
+        assert len(sorted_path_dates(paths, cache=cache)) == 0
+    cache.close()
+    assert probed == ['undated.mp4', 'hung.mp4', 'hung.mp4']
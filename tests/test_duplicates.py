@@ -0,0 +1,93 @@
+import os
+import random
+
+import pytest
+
+from photorg.common import multidict
+from photorg.deduplicate import find_duplicates, sha1sums, hardlink_duplicates, move_duplicates
+
+
+def make_tree(root, seed=1):
+    """files with equal sizes, equal heads and tails, exact copies and hardlinks"""
+    rng = random.Random(seed)
+    blobs = [bytes(rng.randrange(256) for i in range(size)) for size in (0, 10, 100, 100, 1000, 1000, 5000)]
+    # same size, head and tail as blobs[-1], only the middle differs
+    middle = bytearray(blobs[-1])
+    middle[2500] ^= 1
+    blobs.append(bytes(middle))
+    for d in ('a', 'b', 'c/d'):
+        os.makedirs(os.path.join(root, d))
+    paths = []
+    for i in range(40):
+        path = os.path.join(root, rng.choice(['a', 'b', 'c/d']), '{0}.bin'.format(i))
+        with open(path, 'wb') as f:
+            f.write(rng.choice(blobs))
+        paths.append(path)
+    os.link(paths[0], os.path.join(root, 'b', 'link.bin'))
+    return [os.path.join(root, d) for d in ('a', 'b', 'c')]
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_staged_filter_matches_full_hash(tmp_path, jobs):
+    directories = make_tree(str(tmp_path))
+    full = multidict((digest, paths) for digest,paths in sha1sums(directories).items() if len(paths) > 1)
+    staged = find_duplicates(directories, samplesize=16, jobs=jobs)
+    assert staged == full
+    assert list(staged.keys()) == list(full.keys())
+
+
+def write(root, rel, data):
+    path = os.path.join(str(root), rel)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_hardlink_replaces_duplicates(tmp_path, capsys):
+    keep = write(tmp_path, 'a/x.jpg', b'photo')
+    copy = write(tmp_path, 'b/x.jpg', b'photo')
+    linked = os.path.join(str(tmp_path), 'b', 'linked.jpg')
+    os.link(keep, linked)
+    hardlink_duplicates({'digest': [keep, copy, linked]})
+    assert os.path.samefile(keep, copy)
+    with open(copy, 'rb') as f:
+        assert f.read() == b'photo'
+    assert sorted(os.listdir(str(tmp_path / 'b'))) == ['linked.jpg', 'x.jpg']
+    assert '= digest {0} (already linked)'.format(linked) in capsys.readouterr().out
+
+
+def test_hardlink_skips_other_filesystems(tmp_path, monkeypatch, capsys):
+    keep = write(tmp_path, 'a/x.jpg', b'photo')
+    copy = write(tmp_path, 'b/x.jpg', b'photo')
+    stat = os.stat
+    def other_device(path, *args, **kwargs):
+        st = stat(path, *args, **kwargs)
+        if path == copy:
+            fields = list(st[:10])
+            fields[2] += 1
+            return os.stat_result(fields)
+        return st
+    monkeypatch.setattr(os, 'stat', other_device)
+    hardlink_duplicates({'digest': [keep, copy]})
+    monkeypatch.undo()
+    assert not os.path.samefile(keep, copy)
+    assert 'can not hardlink across filesystems: {0}'.format(copy) in capsys.readouterr().out
+
+
+def test_move_keeps_first_and_paths_below_directory(tmp_path, capsys):
+    keep = write(tmp_path, 'a/x.jpg', b'photo')
+    copy = write(tmp_path, 'b/sub/x.jpg', b'photo')
+    vanished = os.path.join(str(tmp_path), 'b', 'gone.jpg')
+    other = write(tmp_path, 'b/y.jpg', b'photo')
+    moved = str(tmp_path / 'moved')
+    move_duplicates({'digest': [keep, copy, vanished, other]}, moved)
+    assert os.path.exists(keep)
+    assert not os.path.exists(copy) and not os.path.exists(other)
+    for path in (copy, other):
+        with open(os.path.join(moved, os.path.relpath(path, '/')), 'rb') as f:
+            assert f.read() == b'photo'
+    # emptied directories are kept, and a vanished path does not stop the rest
+    assert os.path.isdir(os.path.dirname(copy))
+    assert 'Error:File does not exist (or is not a regular file): {0}'.format(vanished) in capsys.readouterr().out
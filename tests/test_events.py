@@ -0,0 +1,76 @@
+import os
+import random
+from datetime import datetime, timedelta
+
+from photorg.photorg import event_plan, organize_by_event
+from photorg.plan import TransferPlan
+from photorg.events import EventIndex, EVENT_INDEX_NAME
+from photorg.deduplicate import scan_files
+
+
+def random_dates(prefix, count, rng, days=(0, 60)):
+    base = datetime(2020, 1, 1)
+    pairs = [('/src/{0}{1}.jpg'.format(prefix, i), base + timedelta(hours=rng.uniform(24 * days[0], 24 * days[1]))) for i in range(count)]
+    return sorted(pairs, key=lambda pair: pair[1])
+
+
+def test_loaded_events_keep_exact_starts(tmp_path):
+    rng = random.Random(3)
+    # a later import continues the last event of the first
+    first = random_dates('a', 40, rng, (0, 30))
+    second = random_dates('b', 40, rng, (30, 60))
+    dest = str(tmp_path / 'dest')
+    os.makedirs(dest)
+    events = EventIndex.load(dest)
+    event_plan(first, dest, 4, events)
+    events.close()
+    events = EventIndex.load(dest)
+    loaded = [os.path.relpath(target, dest) for path,date,target in event_plan(second, dest, 4, events)]
+
+    # the same files grouped by a single run
+    dest = str(tmp_path / 'once')
+    os.makedirs(dest)
+    plan = event_plan(sorted(first + second, key=lambda pair: pair[1]), dest, 4, EventIndex(dest))
+    targets = dict((path, os.path.relpath(target, dest)) for path,date,target in plan)
+    assert loaded == [targets[path] for path,date in second]
+
+
+def test_gap_is_measured_from_the_first_file():
+    # 4 days and 14 hours after an evening start, but 5 days after midnight of its day
+    dates = [('/src/a.jpg', datetime(2024, 1, 1, 20)), ('/src/b.jpg', datetime(2024, 1, 6, 10))]
+    dest = '/nonexistent'
+    events = EventIndex(dest)
+    events.add(dates[0][1], os.path.join(dest, '2024/2024-01-01'))
+    assert events.find(dates[1][1], 4) == os.path.join(dest, '2024/2024-01-01')
+
+
+def test_simulate_does_not_write_the_index(tmp_path):
+    (tmp_path / '2024' / '2024-01-01').mkdir(parents=True)
+    events = EventIndex.load(str(tmp_path), simulate=True)
+    events.add(datetime(2024, 1, 10), str(tmp_path / '2024' / '2024-01-10'))
+    events.close()
+    assert len(events) == 2
+    assert not (tmp_path / EVENT_INDEX_NAME).exists()
+
+
+def test_event_index_is_not_scanned_for_duplicates(tmp_path):
+    for name in ('a', 'b'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / EVENT_INDEX_NAME).write_text('{"events": 1}\n')
+    assert scan_files([str(tmp_path)]) == {}
+
+
+def test_executing_a_saved_plan_records_its_events(tmp_path):
+    source = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    source.mkdir()
+    (source / 'a.jpg').write_bytes(b'a')
+    event_dir = os.path.join(str(dest), '2024/2024-01-01')
+    plan = TransferPlan([(str(source / 'a.jpg'), datetime(2024, 1, 1, 20), os.path.join(event_dir, 'a.jpg'))], str(source), str(dest))
+    plan.save(str(tmp_path / 'plan'))
+    plan.close()
+    organize_by_event(str(source), str(dest), plan_file=str(tmp_path / 'plan'))
+    assert os.path.exists(os.path.join(event_dir, 'a.jpg'))
+    events = EventIndex.load(str(dest))
+    assert events.find(datetime(2024, 1, 6, 21), 4) is None
+    assert events.find(datetime(2024, 1, 6, 19), 4) == event_dir
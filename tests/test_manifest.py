@@ -0,0 +1,41 @@
+import os
+import hashlib
+
+import pytest
+
+from photorg.manifest import Manifest, open_manifest
+
+
+def sha1sum_lines(names):
+    return [hashlib.sha1(name.encode()).hexdigest().encode() + b'  /photos/' + name.encode() + b'\n' for name in names]
+
+
+def test_index_round_trip(tmp_path):
+    manifest = Manifest.read(sha1sum_lines(['a', 'b', 'c', 'a']))
+    index = str(tmp_path / 'photos.idx')
+    manifest.save(index)
+    opened = Manifest.open(index)
+    try:
+        assert len(opened) == 3
+        assert hashlib.sha1(b'b').hexdigest() in opened
+        assert hashlib.sha1(b'd').hexdigest() not in opened
+    finally:
+        opened.close()
+
+
+@pytest.mark.parametrize('data', [b'', b'PHOTORG-SHA1IDX1 truncated'])
+def test_invalid_index(tmp_path, data):
+    index = tmp_path / 'photos.idx'
+    index.write_bytes(data)
+    with pytest.raises(ValueError):
+        open_manifest(None, str(index))
+
+    # rebuilt from the manifest when there is one
+    sums = tmp_path / 'sums.txt'
+    sums.write_bytes(b''.join(sha1sum_lines(['a'])))
+    os.utime(str(index), (os.path.getmtime(str(sums)) + 10,) * 2)
+    manifest = open_manifest(str(sums), str(index))
+    assert len(manifest) == 1
+    opened = Manifest.open(str(index))
+    assert len(opened) == 1
+    opened.close()
@@ -0,0 +1,108 @@
+import os
+import sys
+import struct
+import hashlib
+import zlib
+
+import pytest
+
+from photorg.common import copy_file, set_digest_mode, sha1, sha1_file
+from photorg.payload import payload_sha1
+from photorg.deduplicate import deduplicate_main
+
+
+def segment(marker, data):
+    return b'\xff' + bytes([marker]) + struct.pack('>H', len(data) + 2) + data
+
+
+def jpeg(exif=b'Exif\0\0 2020:01:01 10:00:00', comment=b'', scan=b'\x12\x34\x56\x78'):
+    data = b'\xff\xd8' + segment(0xe1, exif)
+    if comment:
+        data += segment(0xfe, comment)
+    return data + segment(0xdb, b'\0' + bytes(64)) + segment(0xda, b'\x01\x01\x00\x00\x3f\x00') + scan + b'\xff\xd9'
+
+
+def chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png(text=b'Comment\0hello', pixels=b'\x00\xff'):
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) + chunk(b'tEXt', text)
+            + chunk(b'IDAT', zlib.compress(pixels)) + chunk(b'IEND', b''))
+
+
+def box(kind, data):
+    return struct.pack('>I', len(data) + 8) + kind + data
+
+
+def mp4(meta=b'\xa9day2020-01-01', media=b'frames' * 10):
+    # metadata before mdat, so the chunk offsets in moov change with it
+    return box(b'ftyp', b'isom\0\0\0\0') + box(b'moov', box(b'udta', meta)) + box(b'mdat', media)
+
+
+def write(tmp_path, name, data):
+    path = str(tmp_path / name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+@pytest.fixture
+def payload_mode():
+    set_digest_mode('payload')
+    yield
+    set_digest_mode('file')
+
+
+@pytest.mark.parametrize('original,retagged,edited', [
+    (jpeg(), jpeg(exif=b'Exif\0\0 2021:02:02 11:11:11 edited', comment=b'retagged'), jpeg(scan=b'\x12\x34\x56\x79')),
+    (png(), png(text=b'Comment\0a longer comment'), png(pixels=b'\x00\xfe')),
+    (mp4(), mp4(meta=b'\xa9day2021-02-02 retagged'), mp4(media=b'frames' * 11)),
+])
+def test_payload_ignores_metadata(tmp_path, original, retagged, edited):
+    a = write(tmp_path, 'a', original)
+    b = write(tmp_path, 'b', retagged)
+    c = write(tmp_path, 'c', edited)
+    assert sha1_file(a) != sha1_file(b)
+    assert payload_sha1(a) == payload_sha1(b)
+    assert payload_sha1(a) != payload_sha1(c)
+
+
+@pytest.mark.parametrize('data', [
+    jpeg()[:30],                                # truncated inside a segment
+    b'\xff\xd8\xff\xe1\x00\x01' + bytes(20),    # segment length below 2
+    png()[:40],                                 # no IEND
+    box(b'ftyp', b'isom') + box(b'moov', b''),  # no media data
+    box(b'ftyp', b'isom') + struct.pack('>I', 1000) + b'mdat',  # box larger than the file
+    b'plain text',
+])
+def test_malformed_files_are_hashed_in_full(tmp_path, data):
+    path = write(tmp_path, 'bad', data)
+    assert payload_sha1(path) == hashlib.sha1(data).hexdigest()
+
+
+def test_payload_match_does_not_delete_source(tmp_path, payload_mode):
+    # same length, different metadata
+    original = jpeg(exif=b'Exif\0\0 2020:01:01 10:00:00')
+    retagged = jpeg(exif=b'Exif\0\0 2021:02:02 11:11:11')
+    assert len(original) == len(retagged)
+    os.makedirs(str(tmp_path / 'src'))
+    source = write(tmp_path, 'src/a.jpg', retagged)
+    target = write(tmp_path, 'a.jpg', original)
+
+    assert copy_file(source, target, delete=True) == sha1(target)
+    assert os.path.exists(source)
+
+    # an identical source is deleted
+    with open(source, 'wb') as f:
+        f.write(original)
+    copy_file(source, target, delete=True)
+    assert not os.path.exists(source)
+
+
+def test_payload_hardlink_is_refused(tmp_path, monkeypatch):
+    write(tmp_path, 'a.jpg', jpeg())
+    monkeypatch.setattr(sys, 'argv', ['photorg-deduplicate', '--payload', '--hardlink', str(tmp_path)])
+    with pytest.raises(SystemExit) as e:
+        deduplicate_main()
+    assert e.value.code == 2
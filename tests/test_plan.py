@@ -0,0 +1,83 @@
+import os
+import json
+from datetime import datetime
+
+from photorg import photorg
+from photorg.photorg import transfer_files
+from photorg.plan import TransferPlan
+
+
+def journaled(path):
+    plan = TransferPlan.load(path)
+    plan.close()
+    return plan.done
+
+
+def make_plan(tmp_path, names):
+    source = tmp_path / 'src'
+    source.mkdir()
+    entries = []
+    for i,name in enumerate(names):
+        (source / name).write_bytes(name.encode())
+        entries.append((str(source / name), datetime(2024, 1, 1, i), str(tmp_path / 'dest' / name.split('.')[0] / name)))
+    plan = TransferPlan(entries, str(source), str(tmp_path / 'dest'))
+    plan.save(str(tmp_path / 'plan'))
+    return plan
+
+
+def test_resume_after_a_truncated_journal_record(tmp_path):
+    plan = make_plan(tmp_path, ['a.jpg', 'b.jpg'])
+    plan.complete(1, plan.entries[0][2])
+    plan.file.write('{"entry": 2, "sta')
+    plan.close()
+
+    plan = TransferPlan.load(str(tmp_path / 'plan'))
+    assert len(plan.entries) == 2
+    assert plan.done == {1: plan.entries[0][2]}
+    plan.complete(2, plan.entries[1][2])
+    plan.close()
+    with open(str(tmp_path / 'plan')) as f:
+        records = [json.loads(line) for line in f]
+    assert [record.get('entry') for record in records if 'state' in record] == [1, 2]
+    assert journaled(str(tmp_path / 'plan')) == {1: plan.entries[0][2], 2: plan.entries[1][2]}
+
+
+def test_journaled_entries_are_not_touched(tmp_path, monkeypatch):
+    plan = make_plan(tmp_path, ['a.jpg', 'b.jpg'])
+    plan.complete(1, plan.entries[0][2])
+    plan.close()
+    os.unlink(plan.entries[0][0])
+
+    placed = []
+    place_file = photorg.place_file
+    def record(path, target_path, **kwargs):
+        placed.append(path)
+        return place_file(path, target_path, **kwargs)
+    monkeypatch.setattr(photorg, 'place_file', record)
+
+    plan = TransferPlan.load(str(tmp_path / 'plan'))
+    assert transfer_files(plan.entries, journal=plan) == 2
+    plan.close()
+    assert placed == [plan.entries[1][0]]
+    # the event directory of the journaled entry was not even indexed
+    assert not os.path.exists(os.path.dirname(plan.entries[0][2]))
+
+
+def test_failed_entries_are_retried(tmp_path):
+    plan = make_plan(tmp_path, ['a.jpg', 'b.jpg'])
+    collision = plan.entries[0][2]
+    os.makedirs(os.path.dirname(collision))
+    with open(collision, 'wb') as f:
+        f.write(b'other')
+    assert transfer_files(plan.entries, journal=plan) == 1
+    plan.close()
+    assert plan.done == {2: plan.entries[1][2]}
+
+    os.unlink(collision)
+    plan = TransferPlan.load(str(tmp_path / 'plan'))
+    assert plan.done == {2: plan.entries[1][2]}
+    assert transfer_files(plan.entries, journal=plan) == 2
+    plan.close()
+    with open(collision, 'rb') as f:
+        assert f.read() == b'a.jpg'
+    assert journaled(str(tmp_path / 'plan')) == {1: collision, 2: plan.entries[1][2]}
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from photorg.common import scan, ls
+
+
+def make_tree(root):
+    for d in ('a/b/c', 'a/.hidden', 'd', 'e/f', 'e/g/h'):
+        os.makedirs(os.path.join(root, d))
+    for d in ('', 'a', 'a/b', 'a/b/c', 'a/.hidden', 'd', 'e/f', 'e/g/h'):
+        for name in ('x.jpg', '.y.jpg', 'z.mov'):
+            with open(os.path.join(root, d, name), 'w') as f:
+                f.write(d)
+    os.symlink(os.path.join(root, 'a'), os.path.join(root, 'link'))
+    os.symlink(os.path.join(root, 'd', 'x.jpg'), os.path.join(root, 'd', 'link.jpg'))
+
+
+def walk(root, hidden=True):
+    for base, dirs, files in os.walk(root):
+        if not hidden:
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if hidden or not name.startswith('.'):
+                yield os.path.join(base, name)
+
+
+@pytest.mark.parametrize('jobs', [1, 2, 8])
+@pytest.mark.parametrize('hidden', [True, False])
+def test_scan_order_matches_os_walk(tmp_path, jobs, hidden):
+    root = os.path.realpath(str(tmp_path))
+    make_tree(root)
+    assert [entry.path for entry in scan(root, hidden=hidden, jobs=jobs)] == list(walk(root, hidden))
+
+
+def test_ls_relative(tmp_path):
+    root = os.path.realpath(str(tmp_path))
+    make_tree(root)
+    assert list(ls(root, hidden=False)) == [os.path.relpath(path, root) for path in walk(root, hidden=False)]
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from photorg.similar import HammingIndex, similar_groups, hamming, HASH_SIZE
+
+BITS = HASH_SIZE * HASH_SIZE
+
+
+def near_hashes(count, seed=1):
+    """random hashes, and variants of them with a few bits flipped"""
+    rng = random.Random(seed)
+    hashes = []
+    for i in range(count):
+        if hashes and rng.random() < 0.5:
+            value = rng.choice(hashes)
+            for j in range(rng.randrange(0, 12)):
+                value ^= 1 << rng.randrange(BITS)
+        else:
+            value = rng.getrandbits(BITS)
+        hashes.append(value)
+    return hashes
+
+
+@pytest.mark.parametrize('distance', [0, 1, 3, 6, 10, BITS])
+def test_search_matches_brute_force(distance):
+    hashes = near_hashes(400)
+    index = HammingIndex(distance=distance, expected=len(hashes))
+    for i,value in enumerate(hashes):
+        index.add(value, i)
+    for value in hashes[::7]:
+        found = sorted(i for other,items in index.search(value) for i in items)
+        assert found == [i for i,other in enumerate(hashes) if hamming(value, other) <= distance]
+
+
+def brute_force_groups(hashes, distance):
+    parent = list(range(len(hashes)))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i in range(len(hashes)):
+        for j in range(i):
+            if hamming(hashes[i], hashes[j]) <= distance:
+                parent[find(i)] = find(j)
+    groups = {}
+    for i in range(len(hashes)):
+        groups.setdefault(find(i), []).append(i)
+    return sorted(group for group in groups.values() if len(group) > 1)
+
+
+@pytest.mark.parametrize('distance', [0, 4, 6])
+def test_groups_match_brute_force(distance):
+    hashes = near_hashes(300, seed=2)
+    groups = similar_groups(list(enumerate(hashes)), distance)
+    assert sorted(groups) == brute_force_groups(hashes, distance)
@@ -0,0 +1,13 @@
+import sys
+
+import pytest
+
+from photorg.photorg import photorg_main
+
+
+@pytest.mark.parametrize('option', [['--plan', 'plan'], ['--progress'], ['--scan-jobs', '8']])
+def test_watch_refuses_single_run_options(tmp_path, monkeypatch, option):
+    monkeypatch.setattr(sys, 'argv', ['photorg', '--watch'] + option + [str(tmp_path / 'src'), str(tmp_path / 'dest')])
+    with pytest.raises(SystemExit) as e:
+        photorg_main()
+    assert e.value.code == 2